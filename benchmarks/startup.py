@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Cold-start benchmark of the myproject CLI.
+
+Runs each startup path under `python -X importtime` and reports the median
+wall time, the median total import time, the slowest top-level imports and
+which heavy modules were loaded. Paths run with a cache miss of the parsed
+workflow, except "validate-cached" which measures a cache hit.
+
+    python benchmarks/startup.py --runs 20
+"""
+
+import argparse
+import contextlib
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT    = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = os.path.join(ROOT, "myproject")
+
+# Modules that no startup path should load unless it needs them
+HEAVY = ["textual", "rich", "psutil", "asyncio", "yaml", "multiprocessing"]
+
+WORKFLOW = """\
+name: startup
+jobs:
+  job:
+    steps:
+      step:
+        run: "true"
+"""
+
+def scenarios(directory:str) -> dict:
+    """Return the argv of each startup path, and whether it keeps the parsed workflow cache."""
+    path = os.path.join(directory, "workflow.yml")
+    with open(path, "w") as outfile:
+        outfile.write(WORKFLOW)
+    cli = os.path.join(PACKAGE, "cli.py")
+    common = ["--log", os.path.join(directory, "run.log"), "--task-logs", os.path.join(directory, "logs"), "--journal", os.path.join(directory, "runs")]
+    return {
+        "help":            ([cli, "--help"], False),
+        "validate":        ([cli, "--plan", "--path", path] + common, False),
+        "validate-cached": ([cli, "--plan", "--path", path] + common, True),
+        "headless":        ([cli, "--display", "text", "--path", path] + common, False),
+    }
+
+def parse_importtime(stderr:str) -> dict:
+    """Return the cumulative import time in microseconds of every module."""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented below the separating space
+        modules[name[1:].rstrip()] = int(cumulative)
+    return modules
+
+def run(argv:list, directory:str, cached:bool) -> tuple:
+    if not cached:
+        # Workflow.read() writes the parsed workflow next to it, a hit skips importing yaml
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(directory, ".workflow.yml.cache"))
+    env = dict(os.environ, PYTHONPATH=PACKAGE)
+    # Measure with cached bytecode, as an installed package would run
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime"] + argv, cwd=directory, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise Exception(f"{' '.join(argv)} exited with {proc.returncode}:\n{proc.stderr[-2000:]}")
+    return (elapsed, parse_importtime(proc.stderr))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the cold-start time of the CLI.")
+    parser.add_argument("--runs", help="Runs per startup path. (default: 10)", type=int, default=10)
+    parser.add_argument("--top",  help="Slowest top-level imports to list. (default: 5)", type=int, default=5)
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name,(argv,cached) in scenarios(directory).items():
+            # Warm up the bytecode cache, and the parsed workflow cache of cached paths
+            run(argv, directory, cached)
+            walls, imports = [], []
+            for _ in range(options.runs):
+                elapsed, modules = run(argv, directory, cached)
+                walls.append(elapsed)
+                imports.append(sum(v for k,v in modules.items() if not k.startswith(" ")))
+            top = sorted(((v,k) for k,v in modules.items() if not k.startswith(" ")), reverse=True)[0:options.top]
+            loaded = {k.strip() for k in modules}
+            heavy = [module for module in HEAVY if module in loaded]
+            print(f"{name:15} wall {statistics.median(walls) * 1000:7.1f} ms   imports {statistics.median(imports) / 1000:7.1f} ms   heavy: {', '.join(heavy) or '-'}")
+            for cumulative,module in top:
+                print(f"{'':15}   {cumulative / 1000:7.1f} ms  {module}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+import collections
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+
+class ResultCache:
+    # Eviction frees space down to this fraction of max_size, so it doesn't run on every store
+    low_water = 0.9
+
+    def __init__(self, directory:str, max_size:int=1 << 30):
+        """
+        A content-addressed, on-disk cache of task results.
+
+        Entries are keyed by a hash of the fully rendered task spec and the
+        contents of its declared input files. Each entry is a directory
+        holding result.json and copies of the declared output files. When
+        the cache grows past max_size bytes, the least recently used entries
+        are evicted down to low_water of it.
+
+        Sizes and use order are kept in an in-memory LRU index, built by a
+        single scan on the first store, so lookups never scan the cache.
+        """
+        self.directory = directory
+        self.max_size  = max_size
+        self.hashes    = {}
+        self.lock      = threading.Lock()
+        self.index     = None
+        self.size      = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def entries(self) -> list:
+        """Return the paths of all cache entries."""
+        paths = []
+        for prefix in os.listdir(self.directory):
+            prefix = os.path.join(self.directory, prefix)
+            if os.path.isdir(prefix):
+                # Skip the staging directories of entries being stored
+                paths.extend(os.path.join(prefix, key) for key in os.listdir(prefix) if not key.endswith(".tmp"))
+        return paths
+
+    def load_index(self) -> None:
+        """Scan the cache for the size and last use of every entry, least recently used first."""
+        entries = []
+        for path in self.entries():
+            try:
+                used = os.path.getmtime(os.path.join(path, "result.json"))
+            except OSError:
+                used = 0
+            entries.append((used, os.path.basename(path), self.entry_size(path)))
+        self.index = collections.OrderedDict((key, size) for _,key,size in sorted(entries))
+        self.size  = sum(self.index.values())
+
+    def entry_size(self, path:str) -> int:
+        size = 0
+        for root,_,files in os.walk(path):
+            size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        return size
+
+    def path(self, key:str) -> str:
+        return os.path.join(self.directory, key[0:2], key)
+
+    def hash_file(self, path:str) -> str:
+        """Hash the contents of a file, memoized by its size and modification time."""
+        stat = os.stat(path)
+        memo = (path, stat.st_size, stat.st_mtime_ns)
+        if memo not in self.hashes:
+            digest = hashlib.sha256()
+            with open(path, "rb") as infile:
+                for chunk in iter(lambda: infile.read(1 << 20), b""):
+                    digest.update(chunk)
+            self.hashes[memo] = digest.hexdigest()
+        return self.hashes[memo]
+
+    def key(self, spec:dict, inputs:list=[]) -> str:
+        """Return the cache key of a rendered task spec and its input files."""
+        digest = hashlib.sha256(json.dumps(spec, sort_keys=True, default=str).encode())
+        for path in sorted(str(p) for p in inputs):
+            fingerprint = self.hash_file(path) if os.path.exists(path) else "missing"
+            digest.update(f"\0{path}\0{fingerprint}".encode())
+        return digest.hexdigest()
+
+    def get(self, key:str) -> dict:
+        """Return the cached result of key, or None. Declared outputs are restored in place."""
+        path = self.path(key)
+        try:
+            with open(os.path.join(path, "result.json")) as infile:
+                record = json.load(infile)
+            for i,output in enumerate(record.get("outputs", [])):
+                os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+                shutil.copy2(os.path.join(path, "outputs", str(i)), output)
+        except (OSError, ValueError):
+            return None
+        # Mark the entry as recently used
+        os.utime(os.path.join(path, "result.json"))
+        with self.lock:
+            if self.index != None and key in self.index:
+                self.index.move_to_end(key)
+        return record
+
+    def put(self, key:str, record:dict, outputs:list=[]) -> None:
+        """Store the result record of key, along with copies of its declared output files."""
+        path = self.path(key)
+        staging = f"{path}.{os.getpid()}.tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(os.path.join(staging, "outputs"))
+        record = dict(record, outputs=[str(o) for o in outputs], time=time.time())
+        for i,output in enumerate(record["outputs"]):
+            shutil.copy2(output, os.path.join(staging, "outputs", str(i)))
+        with open(os.path.join(staging, "result.json"), "w") as outfile:
+            json.dump(record, outfile)
+
+        # Swap the complete entry into place
+        with self.lock:
+            if self.index == None:
+                self.load_index()
+            if os.path.exists(path):
+                shutil.rmtree(path, ignore_errors=True)
+            self.size -= self.index.pop(key, 0)
+            os.replace(staging, path)
+            self.index[key] = self.entry_size(path)
+            self.size += self.index[key]
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self) -> None:
+        """Remove least recently used entries until the cache is down to low_water of max_size."""
+        while self.index and self.size > self.max_size * self.low_water:
+            key, size = self.index.popitem(last=False)
+            self.size -= size
+            shutil.rmtree(self.path(key), ignore_errors=True)
@@ -1,10 +1,7 @@
-import logging
 import os
 import sys
-from workflow import QueuingHandler, Log, Display, Workflow
-import queue
-import enum
-import copy
+from workflow import Log, Display, Workflow, TaskResult, FailurePolicy
+from executor import ExecutorType
 
 #LOGLEVEL = os.environ["LOGLEVEL"] if "LOGLEVEL" in os.environ else "INFO"
 #logging.basicConfig(level=LOGLEVEL.upper(), format='%(asctime)s %(levelname)s:%(message)s')
@@ -30,39 +27,92 @@ def get_options(args:str=None):
     parser.add_argument('-d', '--display', type=Display.argparse, choices=list(Display), default=Display.GUI)
     parser.add_argument('-p', '--path', help="Workflow YAML file", required=True)
 
+    parser.add_argument('--plan',       help="Validate the workflow and print its task counts and estimated run time, without running it.", action="store_true")
+    parser.add_argument('-j', '--jobs', help="Maximum number of concurrent tasks. (default: CPU count)", type=int, dest="concurrency", default=os.cpu_count())
+    parser.add_argument('-e', '--executor', help=f"Default executor of function steps. (default: {ExecutorType.THREAD})", type=ExecutorType.argparse, choices=list(ExecutorType), default=ExecutorType.THREAD)
+    parser.add_argument('--max-memory', help="Don't start tasks once the memory declared in the limits of running tasks would exceed this size, e.g. 16G.", type=str, dest="max_memory", default=None)
+    parser.add_argument('--cache',      help="Directory of the task result cache, tasks with unchanged specs and inputs are restored instead of run. (default: disabled)", type=str, default=None)
+    parser.add_argument('--cache-size', help="Maximum size of the task result cache. (default: 1G)", type=str, dest="cache_size", default="1G")
+    parser.add_argument('--on-failure', help=f"Keep running the other tasks when a task fails, or cancel them. (default: {FailurePolicy.KEEP_GOING})", type=FailurePolicy.argparse, choices=list(FailurePolicy), dest="policy", default=FailurePolicy.KEEP_GOING)
     parser.add_argument('--unsafe',     help="Enabled unsafe mode", dest="safe", action="store_false")
+    parser.add_argument('--interval',   help="Seconds between progress lines of the text display. (default: 1)", type=float, default=1.0)
     parser.add_argument('--fps',        help="GUI refresh rate. (default: 60)", type=int, default=60)
+    parser.add_argument('--sample-rate', help="Resource sampling rate in Hz. (default: 2)", type=float, dest="sample_rate", default=2)
+    parser.add_argument('--log-budget', help="Maximum log messages drawn per GUI frame, older messages are dropped. (default: 1000)", type=int, dest="log_budget", default=1000)
     parser.add_argument('--log',        help="Path to log file. (default: myproject.log)", type=str, dest="log", default="myproject.log")
+    parser.add_argument('--journal',    help="Directory of run journals, used to resume interrupted runs. (default: .myproject/runs)", type=str, default=".myproject/runs")
+    parser.add_argument('--resume',     help="Run id of an interrupted run to resume, its completed tasks are skipped.", type=str, default=None)
+    parser.add_argument('--task-logs',  help="Directory of per-task output logs. (default: logs)", type=str, dest="task_dir", default="logs")
+    parser.add_argument('--tail',       help="Number of output lines per task kept in memory. (default: 100)", type=int, default=100)
+    parser.add_argument('--listen',     help="Run tasks on remote workers connecting to this host:port or unix:path, instead of locally. Set --jobs to the total worker slots. The protocol is unauthenticated, only listen on trusted networks.", type=str, default=None)
     
     return (sys_argv_original, parser.parse_args())
 
-from gui import Gui
+def get_worker_options(args:list):
+    """
+    Parse the CLI options of a worker.
 
-if __name__ == "__main__":
+    >>> options = get_worker_options(["--connect", "localhost:7000"])
 
-    # Parse CLI options
-    sys_argv_original = sys.argv
-    sys.argv, options = get_options("test -p path --display text")
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="myproject worker", description="Run the tasks of a workflow started with --listen.")
+    parser.add_argument('-c', '--connect', help="Address of the coordinator, host:port or unix:path", required=True)
+    parser.add_argument('-j', '--jobs',    help="Number of concurrent tasks. (default: CPU count)", type=int, dest="slots", default=os.cpu_count())
+    parser.add_argument('-e', '--executor', help=f"Default executor of function steps. (default: {ExecutorType.THREAD})", type=ExecutorType.argparse, choices=list(ExecutorType), default=ExecutorType.THREAD)
+    parser.add_argument('--unsafe',        help="Enabled unsafe mode", dest="safe", action="store_false")
+    parser.add_argument('--heartbeat',     help="Seconds between heartbeats. (default: 2)", type=float, default=2.0)
+    parser.add_argument('--log',           help="Path to log file. (default: none)", type=str, dest="log", default=None)
+    return parser.parse_args(args)
+
+if __name__ == "__main__":
 
     # Adjust the default log level based on environment variables
     log_level = os.environ["LOGLEVEL"].upper() if "LOGLEVEL" in os.environ else "INFO"
 
+    if len(sys.argv) > 1 and sys.argv[1] == "worker":
+        import asyncio
+        from distributed import Worker
+        options = get_worker_options(sys.argv[2:])
+        log = Log(name="worker", level=log_level, file=options.log, task_dir=None)
+        worker = Worker(options.connect, slots=options.slots, safe=options.safe, executor=options.executor, heartbeat=options.heartbeat, log=log)
+        asyncio.run(worker.run())
+        worker.close()
+        sys.exit(0)
+
+    # Parse CLI options
+    sys_argv_original = sys.argv
+    sys.argv, options = get_options()
+
     # Log configuration that will be used by all display options.
-    log = Log(level=log_level, file=options.log)
-    workflow = Workflow(path=options.path, log=log) 
-    workflow.logger.debug("This is a debug test.")
-    workflow.logger.info("This is an info test.")
-    workflow.logger.warning("This is a warning test.")
-
-    # # Display/run Option 1.
-    # if options.display == Display.GUI:
-    #     log.stdout = False
-    #     kwargs = {k:v for k,v in vars(options).items() if k in ["path", "safe", "fps"]}
-    #     kwargs["log"] = log
-    #     Gui(**kwargs).run()
-    # elif options.display == Display.TEXT:
-    #     log.stdout = True
-    #     workflow = Workflow(path=options.path, log=log) 
-    #     workflow.logger.debug("This is a debug test.")
-    #     workflow.logger.info("This is an info test.")
-    #     workflow.logger.warning("This is a warning test.")
+    log = Log(level=log_level, file=options.log, task_dir=options.task_dir, tail=options.tail, stdout=False)
+    kwargs = {k:v for k,v in vars(options).items() if k in ["path", "safe", "concurrency", "executor", "max_memory", "cache", "cache_size", "journal", "resume", "listen", "policy"]}
+
+    if options.plan:
+        # Neither truncate the log of the last run nor start a new journal
+        log.file = None
+        try:
+            workflow = Workflow(log=log, **dict(kwargs, journal=None, resume=None))
+        except Exception as e:
+            print(f"Invalid workflow {options.path}: {e}", file=sys.stderr)
+            sys.exit(1)
+        print(workflow.plan(history=options.journal))
+        workflow.close()
+        sys.exit(0)
+
+    # Display/run Option 1.
+    if options.display == Display.GUI:
+        # Only the GUI pays for importing Textual
+        from gui import Gui
+        kwargs.update({k:v for k,v in vars(options).items() if k in ["fps", "log_budget", "sample_rate"]})
+        gui = Gui(log=log, **kwargs)
+        gui.run()
+        failed = gui.workflow.results[TaskResult.FAIL] + len(gui.workflow.errors)
+        sys.exit(1 if failed else 0)
+    elif options.display == Display.TEXT:
+        from headless import Headless
+        workflow = Workflow(log=log, **kwargs)
+        status = Headless(workflow, interval=options.interval).run()
+        workflow.close()
+        sys.exit(status)
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+
+import asyncio
+import collections
+import json
+import logging
+import os
+import socket
+import time
+
+from executor import Executor, ExecutorType, create_executor
+from workflow import Task, Log, Limits, enqueue_logger, executor_kind
+
+# Longest protocol message, a line of task output is at most Task.chunk_size
+MESSAGE_LIMIT = 1 << 24
+
+def parse_address(address:str) -> tuple:
+    """
+    Parse a host:port TCP address, or a unix:path socket address.
+
+    >>> parse_address("localhost:7000")
+    ('localhost', 7000)
+    >>> parse_address("unix:/tmp/myproject.sock")
+    ('/tmp/myproject.sock', None)
+    """
+    if address.startswith("unix:"):
+        return (address[len("unix:"):], None)
+    host, _, port = address.rpartition(":")
+    if not host or not port.isdigit():
+        raise Exception(f"Invalid address '{address}', expected host:port or unix:path")
+    return (host, int(port))
+
+def send(writer:asyncio.StreamWriter, message:dict) -> None:
+    """Queue a message on a connection, messages are JSON lines."""
+    writer.write(json.dumps(message, default=str).encode() + b"\n")
+
+async def receive(reader:asyncio.StreamReader) -> dict:
+    """Return the next message of a connection, or None once it is closed."""
+    line = await reader.readline()
+    return json.loads(line) if line else None
+
+class RemoteWorker:
+    def __init__(self, identifier:str, writer:asyncio.StreamWriter, slots:int):
+        """The coordinator's view of a connected worker."""
+        self.identifier = identifier
+        self.writer     = writer
+        self.slots      = slots
+        self.assigned   = collections.OrderedDict()
+        self.started    = set()
+        self.last_seen  = time.monotonic()
+        self.stealing   = False
+
+    def backlog(self) -> int:
+        """Number of tasks sent to the worker that it hasn't started yet."""
+        return len(self.assigned) - len(self.started)
+
+    def __repr__(self):
+        return self.identifier
+
+class Coordinator:
+    def __init__(self, address:str, logger:logging.Logger, log:Log=None, prefetch:int=1, heartbeat_timeout:float=10):
+        """
+        Hand tasks to remote workers over TCP or a Unix socket.
+
+        Workers connect with `cli.py worker --connect <address>` and announce
+        their slots. Each worker is sent up to slots + prefetch tasks, the rest
+        wait in a central queue. A worker that runs dry while others still
+        have a backlog steals half of the largest one. Workers heartbeat, and
+        the tasks of a worker that goes quiet for heartbeat_timeout seconds
+        or disconnects are requeued. Task output is streamed back line by
+        line while the task runs.
+
+        Workers run the task spec as-is, so declared inputs and outputs need
+        a filesystem shared with the coordinator.
+        """
+        self.address   = address
+        self.logger    = logger
+        self.log       = log if log != None else Log()
+        self.prefetch  = prefetch
+        self.heartbeat_timeout = heartbeat_timeout
+        self.server    = None
+        self.monitor   = None
+        self.workers   = {}
+        self.pending   = collections.deque()
+        self.tasks     = {}
+        self.outputs   = {}
+        self.connections = set()
+        self.closing   = False
+
+    async def start(self) -> None:
+        path, port = parse_address(self.address)
+        if port == None:
+            self.server = await asyncio.start_unix_server(self.connected, path=path, limit=MESSAGE_LIMIT)
+        else:
+            self.server = await asyncio.start_server(self.connected, host=path, port=port, limit=MESSAGE_LIMIT)
+        self.monitor = asyncio.create_task(self.check_heartbeats())
+        self.logger.info(f"Coordinator listening on {self.address}")
+
+    async def close(self) -> None:
+        """Shut the workers down and wait for their connections to close."""
+        self.closing = True
+        for worker in list(self.workers.values()):
+            send(worker.writer, {"type": "shutdown"})
+            worker.writer.close()
+        if self.monitor != None:
+            self.monitor.cancel()
+        if self.server != None:
+            self.server.close()
+        if self.connections:
+            await asyncio.wait(self.connections, timeout=self.heartbeat_timeout)
+        path, port = parse_address(self.address)
+        if port == None and os.path.exists(path):
+            os.remove(path)
+
+    async def execute(self, task:Task) -> None:
+        """Run a task on a worker, called by Task.execute in place of running it locally."""
+        future = asyncio.get_running_loop().create_future()
+        self.tasks[task.name] = (task, future, collections.deque(maxlen=self.log.tail), collections.deque(maxlen=self.log.tail))
+        self.pending.append(task.name)
+        if not self.workers:
+            self.logger.info(f"Waiting for a worker to run task: {task}")
+        self.assign()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Timed out or cancelled, stop it wherever it is
+            if task.name in self.pending:
+                self.pending.remove(task.name)
+            for worker in self.workers.values():
+                if worker.assigned.pop(task.name, None) != None:
+                    worker.started.discard(task.name)
+                    send(worker.writer, {"type": "cancel", "task": task.name})
+            self.assign()
+            raise
+        finally:
+            self.tasks.pop(task.name, None)
+            for outfile in self.outputs.pop(task.name, {}).values():
+                outfile.close()
+
+    def assign(self) -> None:
+        """Send pending tasks to the least loaded workers with room, or steal work for idle ones."""
+        while self.pending:
+            candidates = [w for w in self.workers.values() if len(w.assigned) < w.slots + self.prefetch]
+            if not candidates:
+                return
+            worker = min(candidates, key=lambda w: len(w.assigned) / w.slots)
+            name = self.pending.popleft()
+            task = self.tasks[name][0]
+            worker.assigned[name] = task
+            send(worker.writer, {"type": "task", "task": name, "data": task.data})
+
+        idle = [w for w in self.workers.values() if len(w.assigned) < w.slots]
+        victims = [w for w in self.workers.values() if w.backlog() > 0 and not w.stealing]
+        if idle and victims:
+            victim = max(victims, key=lambda w: w.backlog())
+            victim.stealing = True
+            send(victim.writer, {"type": "steal", "count": max(1, victim.backlog() // 2)})
+
+    async def connected(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter) -> None:
+        worker = None
+        self.connections.add(asyncio.current_task())
+        try:
+            hello = await receive(reader)
+            if hello == None or hello.get("type") != "hello":
+                return
+            worker = RemoteWorker(str(hello["worker"]), writer, max(1, int(hello["slots"])))
+            self.workers[worker.identifier] = worker
+            self.logger.info(f"Worker connected: {worker} ({worker.slots} slots)")
+            self.assign()
+            while True:
+                message = await receive(reader)
+                if message == None:
+                    break
+                worker.last_seen = time.monotonic()
+                self.handle(worker, message)
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Connection to worker {worker} failed: {e}")
+        finally:
+            self.connections.discard(asyncio.current_task())
+            writer.close()
+            if worker != None and self.workers.get(worker.identifier) is worker:
+                self.lost(worker)
+
+    def handle(self, worker:RemoteWorker, message:dict) -> None:
+        kind, name = message["type"], message.get("task")
+        # Ignore messages about tasks the worker no longer owns, e.g. after a requeue
+        if name != None and name not in worker.assigned:
+            return
+        if kind == "started":
+            worker.started.add(name)
+        elif kind == "output":
+            self.output(name, message["stream"], message["line"])
+        elif kind == "result":
+            worker.assigned.pop(name)
+            worker.started.discard(name)
+            task, future, stdout, stderr = self.tasks[name]
+            task.return_code = message["return_code"]
+            task.output      = message.get("output")
+            task.error       = message.get("error")
+            task.stdout      = message.get("stdout") if message.get("stdout") != None else ("\n".join(stdout).strip() or None)
+            task.stderr      = message.get("stderr") if message.get("stderr") != None else ("\n".join(stderr).strip() or None)
+            if not future.done():
+                future.set_result(None)
+            self.assign()
+        elif kind == "released":
+            worker.stealing = False
+            released = [n for n in message["tasks"] if n in worker.assigned and n not in worker.started]
+            for n in released:
+                worker.assigned.pop(n)
+            self.pending.extendleft(reversed(released))
+            if released:
+                self.logger.debug(f"Stole {len(released)} tasks from worker {worker}")
+            self.assign()
+
+    def output(self, name:str, stream:str, line:str) -> None:
+        """Log and keep a streamed line of task output, as Task.stream does for local tasks."""
+        task, _, stdout, stderr = self.tasks[name]
+        (stdout if stream == "stdout" else stderr).append(line)
+        self.logger.info(f"{name} [{stream}] {line}")
+        if not self.log.task_dir:
+            return
+        files = self.outputs.setdefault(name, {})
+        if stream not in files:
+            os.makedirs(self.log.task_dir, exist_ok=True)
+            task.log_files[stream] = os.path.join(self.log.task_dir, f"{name}.{stream}.log")
+            files[stream] = open(task.log_files[stream], "w")
+        files[stream].write(line + "\n")
+
+    def lost(self, worker:RemoteWorker) -> None:
+        """Forget a worker, requeueing the tasks it had."""
+        del self.workers[worker.identifier]
+        if self.closing:
+            return
+        requeued = [name for name in worker.assigned if name in self.tasks]
+        self.pending.extendleft(reversed(requeued))
+        self.logger.warning(f"Worker lost: {worker}, requeued {len(requeued)} tasks")
+        self.assign()
+
+    async def check_heartbeats(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat_timeout / 2)
+            now = time.monotonic()
+            for worker in list(self.workers.values()):
+                if now - worker.last_seen > self.heartbeat_timeout:
+                    self.logger.warning(f"No heartbeat from worker {worker} for {now - worker.last_seen:.1f}s")
+                    worker.writer.close()
+                    if self.workers.get(worker.identifier) is worker:
+                        self.lost(worker)
+
+class Worker:
+    def __init__(
+        self,
+        address:str,
+        slots:int=None,
+        safe:bool=True,
+        executor:ExecutorType=ExecutorType.THREAD,
+        heartbeat:float=2.0,
+        log:Log=None,
+    ):
+        """
+        Run tasks handed out by a Coordinator, up to slots at a time.
+
+        Tasks run exactly as they would locally, with their limits and
+        executors. Safe mode is decided by the worker, not the coordinator.
+        """
+        self.address   = address
+        self.slots     = slots if slots else os.cpu_count()
+        self.safe      = safe
+        self.executor  = executor
+        self.heartbeat = heartbeat
+        self.log       = log if log != None else Log(name="worker", file=None, task_dir=None)
+        self.logger    = None
+        self.identifier = f"{socket.gethostname()}:{os.getpid()}"
+        self.executors = {}
+        self.queue     = collections.deque()
+        self.running   = {}
+        self.writer    = None
+        self.completed = 0
+        self.create_logger()
+
+    def create_logger(self) -> None:
+        """Create a logger that only enqueues records, as Workflow.create_logger does."""
+        self.logger, self.log_listener = enqueue_logger(self.log)
+
+    def close(self) -> None:
+        """Flush and stop the log listener."""
+        self.log_listener.stop()
+
+    async def connect(self, retries:int=50, delay:float=0.2) -> tuple:
+        path, port = parse_address(self.address)
+        for attempt in range(retries):
+            try:
+                if port == None:
+                    return await asyncio.open_unix_connection(path, limit=MESSAGE_LIMIT)
+                return await asyncio.open_connection(path, port, limit=MESSAGE_LIMIT)
+            except OSError:
+                if attempt == retries - 1:
+                    raise
+                await asyncio.sleep(delay)
+
+    async def run(self) -> None:
+        reader, self.writer = await self.connect()
+        send(self.writer, {"type": "hello", "worker": self.identifier, "slots": self.slots})
+        self.logger.info(f"Worker {self.identifier} connected to {self.address} ({self.slots} slots)")
+        beat = asyncio.create_task(self.beat())
+        try:
+            while True:
+                message = await receive(reader)
+                if message == None or message["type"] == "shutdown":
+                    break
+                self.handle(message)
+        finally:
+            beat.cancel()
+            self.queue.clear()
+            for running in list(self.running.values()):
+                running.cancel()
+            await asyncio.gather(*self.running.values(), return_exceptions=True)
+            for executor in self.executors.values():
+                executor.shutdown()
+            self.writer.close()
+            self.logger.info(f"Worker {self.identifier} done, ran {self.completed} tasks")
+
+    async def beat(self) -> None:
+        while True:
+            send(self.writer, {"type": "heartbeat"})
+            await self.writer.drain()
+            await asyncio.sleep(self.heartbeat)
+
+    def handle(self, message:dict) -> None:
+        kind = message["type"]
+        if kind == "task":
+            self.queue.append(message)
+            self.start_tasks()
+        elif kind == "cancel":
+            name = message["task"]
+            self.queue = collections.deque(m for m in self.queue if m["task"] != name)
+            if name in self.running:
+                self.running[name].cancel()
+        elif kind == "steal":
+            # Give up the tasks that would start last
+            released = [self.queue.pop()["task"] for _ in range(min(message["count"], len(self.queue)))]
+            send(self.writer, {"type": "released", "tasks": released})
+
+    def start_tasks(self) -> None:
+        while self.queue and len(self.running) < self.slots:
+            message = self.queue.popleft()
+            self.running[message["task"]] = asyncio.create_task(self.run_task(message["task"], message["data"]))
+
+    def get_executor(self, data:dict, limits:Limits) -> Executor:
+        kind = executor_kind(data, limits, self.executor)
+        if kind not in self.executors:
+            self.executors[kind] = create_executor(kind, max_workers=self.slots)
+        return self.executors[kind]
+
+    async def run_task(self, name:str, data:dict) -> None:
+        try:
+            send(self.writer, {"type": "started", "task": name})
+            limits = Limits.from_step(data)
+            task = Task(name, data, safe=self.safe, executor=self.get_executor(data, limits), log=self.log, logger=self.logger, limits=limits)
+            task.listener = lambda stream, line: send(self.writer, {"type": "output", "task": name, "stream": stream, "line": line})
+            await task.run()
+            # Shell output was already streamed, function output is sent with the result
+            send(self.writer, {
+                "type":        "result",
+                "task":        name,
+                "return_code": task.return_code,
+                "error":       task.error,
+                "output":      task.output,
+                "stdout":      task.stdout if task.function() != None else None,
+            })
+            await self.writer.drain()
+            self.completed += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # Fail the task rather than leave the coordinator waiting for its result forever
+            self.logger.error(f"Task {name} failed on worker {self.identifier}: {e!r}")
+            send(self.writer, {"type": "result", "task": name, "return_code": 1, "error": repr(e)})
+        finally:
+            self.running.pop(name, None)
+            self.start_tasks()
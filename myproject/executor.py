@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import abc
+import concurrent.futures
+import enum
+import signal
+
+
+class ExecutorType(enum.IntEnum):
+    INLINE = 1
+    THREAD = 2
+    PROCESS = 3
+    ISOLATED = 4
+
+    def __str__(self):
+        return self.name.lower()
+
+    def __repr__(self):
+        return str(self)
+
+    @staticmethod
+    def argparse(s):
+        try:
+            return ExecutorType[s.upper()]
+        except KeyError:
+            return s
+
+class Executor(abc.ABC):
+    """
+    Backend that runs the python callables of function steps.
+
+    The callable and its arguments must be picklable for backends that
+    run in another process. Results and exceptions are returned to the
+    awaiting task in all backends.
+    """
+
+    def __init__(self, max_workers:int=None):
+        self.max_workers = max_workers
+
+    @abc.abstractmethod
+    async def run(self, fn, *args):
+        """Run fn(*args) on the backend and return its result."""
+
+    def shutdown(self, wait:bool=True) -> None:
+        pass
+
+class InlineExecutor(Executor):
+    """Run callables directly in the event loop thread, for trivial expressions."""
+
+    async def run(self, fn, *args):
+        return fn(*args)
+
+class PoolExecutor(Executor):
+    # Name of the concurrent.futures pool, looked up on first use so that
+    # importing this module doesn't import multiprocessing
+    pool_class = None
+
+    def __init__(self, max_workers:int=None):
+        super().__init__(max_workers)
+        self.pool = getattr(concurrent.futures, self.pool_class)(max_workers=max_workers)
+
+    async def run(self, fn, *args):
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+
+    def shutdown(self, wait:bool=True) -> None:
+        self.pool.shutdown(wait=wait, cancel_futures=True)
+
+class ThreadExecutor(PoolExecutor):
+    """Run callables in a thread pool, for steps that block on I/O or sleep."""
+    pool_class = "ThreadPoolExecutor"
+
+class ProcessExecutor(PoolExecutor):
+    """Run callables in a process pool, for CPU-bound steps that would serialize on the GIL."""
+    pool_class = "ProcessPoolExecutor"
+
+def call(writer, fn, args) -> None:
+    """Entry point of the processes of IsolatedExecutor, sends back the result or the exception."""
+    try:
+        result = (True, fn(*args))
+    except BaseException as e:
+        result = (False, e)
+    writer.send(result)
+
+class IsolatedExecutor(Executor):
+    """
+    Run each callable in a new process, for steps with resource limits or a timeout.
+
+    The process is killed when the task is cancelled or times out, so unlike
+    a pool worker it can't keep running and hold a slot, and resource limits
+    never outlive the task.
+    """
+
+    async def run(self, fn, *args):
+        import asyncio
+        import multiprocessing
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=call, args=(writer, fn, args), daemon=True)
+        process.start()
+        writer.close()
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        loop.add_reader(reader.fileno(), lambda: readable.done() or readable.set_result(None))
+        try:
+            await readable
+            try:
+                ok, result = reader.recv()
+            except EOFError:
+                # Killed before sending a result, e.g. by the hard CPU time limit
+                process.join()
+                if process.exitcode < 0:
+                    raise Exception(f"Process killed by {signal.Signals(-process.exitcode).name}")
+                raise Exception(f"Process exited with code {process.exitcode}")
+        finally:
+            loop.remove_reader(reader.fileno())
+            reader.close()
+            if process.is_alive():
+                process.kill()
+            process.join()
+        if not ok:
+            raise result
+        return result
+
+EXECUTORS = {
+    ExecutorType.INLINE:   InlineExecutor,
+    ExecutorType.THREAD:   ThreadExecutor,
+    ExecutorType.PROCESS:  ProcessExecutor,
+    ExecutorType.ISOLATED: IsolatedExecutor,
+}
+
+def create_executor(kind:ExecutorType, max_workers:int=None) -> Executor:
+    return EXECUTORS[kind](max_workers=max_workers)
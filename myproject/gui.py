@@ -1,22 +1,28 @@
 #!/usr/bin/env python3
 
+import array
 import asyncio
-from collections import OrderedDict
-from datetime import datetime
+import collections
 import time
-import psutil
-import threading
 
 import queue
 import logging
-from workflow import Workflow, QueuingHandler, Log
+from workflow import Workflow, QueuingHandler, DropOldestQueue, Log, Event, EventType, TaskStatus, TaskResult, FailurePolicy
+from executor import ExecutorType
+from resources import ResourceSampler, Snapshot
 
 from textual.app import App, ComposeResult
-from textual.containers import HorizontalGroup, Horizontal, Center, Middle
+from textual.containers import Horizontal, Center, Middle
 from textual import work, events
-from textual.widgets import Header, Footer, Static, RichLog, Tree, Label, ProgressBar
+from textual.widgets import Header, Footer, Static, RichLog, Tree, Label
 from textual.timer import Timer  
 from textual.renderables import bar
+from textual.scroll_view import ScrollView
+from textual.geometry import Size
+from textual.strip import Strip
+from rich.segment import Segment
+from rich.style import Style
+from rich.text import Text
 
 
 class TaskTree(Tree):
@@ -30,44 +36,59 @@ class TaskTree(Tree):
         padding: 1 1;
     }
     """
-    pass
-
-class ProgressJob(HorizontalGroup):
-    DEFAULT_CSS = """
-    Label {
-        width: 14;
-    }
-    .custom-bar Bar {
-        width: 15;
+    icons = {
+        TaskStatus.PENDING:  "⏸",
+        TaskStatus.RUNNING:  "⏩",
+        TaskResult.PASS:     "✅",
+        TaskResult.FAIL:     "❌",
+        TaskResult.CANCELLED: "⏹",
     }
-    .custom-bar Bar > .bar--bar {
-        color: blue;
-        background: yellow 30%;
-    }
-    """
-    job = None
-    total = 0
-    steps = 0
-    label = None
-    bar = None
-    max_label_len = 10
 
-    def __init__(self, job:str, total:int=0, completed:int=0):
-        self.job = job
-        self.total = total
-        super().__init__()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Index of identifier to tree node, for O(1) updates
+        self.nodes = {}
 
-    def compose(self) -> ComposeResult:
-        if len(self.job) > self.max_label_len:
-            self.label = Label(f"{self.job[0:self.max_label_len]}...")
+    def label(self, event:Event) -> str:
+        name = event.identifier.split(".")[-1]
+        if event.status == TaskStatus.COMPLETE:
+            icon = self.icons.get(event.result, "✅")
         else:
-            self.label = Label(self.job)
-        yield self.label
-        self.bar = ProgressBar(10, classes="custom-bar")
-        self.bar.advance(5)
-        yield self.bar
-
-class Progress(Static):
+            icon = self.icons.get(event.status, "")
+        return "{:10} {:5}".format(name, icon)
+
+    def apply(self, events:list) -> None:
+        """Apply a diff stream of workflow events, touching only the nodes they name."""
+        for event in events:
+            if event.type == EventType.ADD:
+                parent = self.nodes.get(event.parent, self.root)
+                if event.leaf:
+                    self.nodes[event.identifier] = parent.add_leaf(self.label(event))
+                else:
+                    self.nodes[event.identifier] = parent.add(self.label(event), expand=True)
+            elif event.type == EventType.UPDATE:
+                node = self.nodes.get(event.identifier)
+                if node == None:
+                    continue
+                node.set_label(self.label(event))
+                # Completed subtrees are collapsed so they don't cost render lines
+                if event.status == TaskStatus.COMPLETE and not event.leaf:
+                    node.collapse()
+            elif event.type == EventType.REMOVE:
+                node = self.nodes.pop(event.identifier, None)
+                if node != None:
+                    node.remove()
+
+    def reconcile(self, tasks:dict, steps:dict) -> None:
+        """Bring task leaves up to date after events were dropped, tasks no longer tracked have passed."""
+        for identifier in [identifier for identifier in self.nodes if identifier not in steps]:
+            task = tasks.get(identifier)
+            if task == None or task.result == TaskResult.PASS:
+                self.nodes.pop(identifier).remove()
+            else:
+                self.nodes[identifier].set_label(self.label(Event(EventType.UPDATE, identifier, task.status, task.result, leaf=True)))
+
+class Progress(ScrollView):
     BORDER_TITLE = "Progress"
     DEFAULT_CSS = """
     Progress {
@@ -75,17 +96,69 @@ class Progress(Static):
         height: 100%;
         border: solid green;
         border-title-align: center;
+        border-subtitle-align: center;
         padding: 1 1;
     }
     """
-
-    text = "Test"
-
-    jobs = OrderedDict()
-
-    def add_job(self, job:str, total=None) -> None:
-        self.jobs[job] = ProgressJob(job=job, total=total)
-        self.mount(self.jobs[job])
+    max_label_len = 10
+    bar_width = 15
+
+    def __init__(self, *args, **kwargs):
+        """
+        A progress panel that only renders the visible rows of jobs.
+
+        Jobs are stored in a compact backing model of parallel name, total
+        and completed arrays, rather than a widget per job.
+        """
+        super().__init__(*args, **kwargs)
+        self.names     = []
+        self.index     = {}
+        self.totals    = array.array("q")
+        self.completed = array.array("q")
+        self.counts    = {"Complete": 0, "Pass": 0, "Fail": 0, "Running": 0}
+
+    def add_job(self, job:str, total:int=0) -> None:
+        self.index[job] = len(self.names)
+        self.names.append(job)
+        self.totals.append(total)
+        self.completed.append(0)
+        self.virtual_size = Size(14 + self.bar_width + 20, len(self.names))
+        self.refresh()
+
+    def set_counts(self, running:int, passed:int, failed:int) -> None:
+        self.counts = {"Complete": passed + failed, "Pass": passed, "Fail": failed, "Running": running}
+        self.update_summary()
+
+    def set_completed(self, job:str, completed:int) -> None:
+        i = self.index.get(job)
+        if i == None or self.completed[i] == completed:
+            return
+        self.completed[i] = completed
+        # Only redraw the row if it's in the visible window
+        y = i - self.scroll_offset.y
+        if 0 <= y < self.size.height:
+            self.refresh_lines(y)
+
+    def update_summary(self) -> None:
+        self.border_subtitle = " | ".join(f"{k}: {v}" for k,v in self.counts.items())
+
+    def render_line(self, y:int) -> Strip:
+        i = y + self.scroll_offset.y
+        if i >= len(self.names):
+            return Strip.blank(self.size.width, self.rich_style)
+        name = self.names[i]
+        if len(name) > self.max_label_len:
+            name = f"{name[0:self.max_label_len]}..."
+        total, completed = self.totals[i], self.completed[i]
+        fraction = min(1, completed / total) if total else 1
+        filled = int(fraction * self.bar_width)
+        segments = [
+            Segment(f"{name:14}", self.rich_style),
+            Segment("━" * filled, Style(color="blue")),
+            Segment("━" * (self.bar_width - filled), Style(color="yellow", dim=True)),
+            Segment(f" {int(fraction * 100):>3}% {completed}/{total}", self.rich_style),
+        ]
+        return Strip(segments).crop(self.scroll_offset.x, self.scroll_offset.x + self.size.width)
 
 class Backend(Static):
     BORDER_TITLE = "Backend"
@@ -99,21 +172,39 @@ class Backend(Static):
     }
     """
 
-    threads = threading.active_count()
-    memory = psutil.virtual_memory().used >> 20
-    fps = 0
-    fps_time = datetime.now()
-    concurrent = 0
-    messages = 0
-    tasks = 0
-
-    def compose(self) -> ComposeResult:
-        yield Label(f"Threads:     {self.threads}")
-        yield Label(f"Memory:      {self.memory} MB")
-        yield Label(f"FPS:         {int(self.fps)}")
-        yield Label(f"Concurrent:  {self.concurrent}")
-        yield Label(f"Messages:    {self.messages}")
-        yield Label(f"Tasks:       {self.tasks}")
+    # Number of busiest tasks to list
+    top = 3
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fps      = 0
+        self.fps_time = time.monotonic()
+        self.snapshot = None
+
+    def tick(self) -> None:
+        """Count a redraw of the GUI, to report the effective FPS."""
+        now = time.monotonic()
+        self.fps = 1 / max(now - self.fps_time, 1e-6)
+        self.fps_time = now
+
+    def show(self, snapshot:Snapshot, concurrent:int, messages:tuple, events:tuple, tasks:int) -> None:
+        """Show a resource snapshot, messages and events are (queue depth, dropped) pairs."""
+        self.snapshot = snapshot
+        lines = [
+            f"Threads:     {snapshot.threads}",
+            f"Memory:      {snapshot.memory >> 20} MB",
+            f"FPS:         {int(self.fps)}",
+            f"Concurrent:  {concurrent}",
+            f"Messages:    {messages[0]} ({messages[1]} dropped)",
+            f"Events:      {events[0]} ({events[1]} dropped)",
+            f"Tasks:       {tasks}",
+        ]
+        busiest = sorted(snapshot.tasks.items(), key=lambda item: item[1].cpu, reverse=True)[0:self.top]
+        if busiest:
+            lines.append("")
+        for name,sample in busiest:
+            lines.append(f"{name[-12:]:12} {sample.cpu:4.0f}% {sample.rss >> 20:>5} MB {sample.fds:>3} fd")
+        self.update("\n".join(lines))
 
 class Log(RichLog):
     BORDER_TITLE = "Log"
@@ -161,12 +252,38 @@ class Gui(App):
         text-align: right;
     }
     """
-    messages = queue.Queue()
     workflow = None
 
-    def __init__(self, path:str, fps:int=60, safe:bool=True, log:Log=None):
+    def __init__(
+        self,
+        path:str,
+        fps:int=60,
+        safe:bool=True,
+        concurrency:int=None,
+        executor:ExecutorType=ExecutorType.THREAD,
+        log_budget:int=1000,
+        sample_rate:float=2,
+        max_memory:str=None,
+        cache:str=None,
+        cache_size:str="1G",
+        journal:str=None,
+        resume:str=None,
+        listen:str=None,
+        policy:FailurePolicy=FailurePolicy.KEEP_GOING,
+        log:Log=None,
+    ):
         self.fps = fps
-        self.workflow = Workflow(path, log=log)
+        self.sample_rate = sample_rate
+        self.log_budget = log_budget
+        self.dropped = 0
+        self.messages = DropOldestQueue(maxsize=log_budget)
+        self.events_dropped = 0
+        self.workflow = Workflow(path, log=log, concurrency=concurrency, safe=safe, executor=executor, max_memory=max_memory, cache=cache, cache_size=cache_size, journal=journal, resume=resume, listen=listen, policy=policy)
+        # Expected number of tasks per job, for the progress bars
+        self.job_totals = collections.Counter()
+        for node in self.workflow.tree.values():
+            if node.step != None:
+                self.job_totals[node.job] += node.weight
         super().__init__()
 
     def compose(self) -> ComposeResult:
@@ -177,7 +294,6 @@ class Gui(App):
                 yield Footer()
             yield Label("This is the right side label", id="right-label")
 
-        self.task_tree_lookup = {}
         self.task_tree = TaskTree("Tasks")
         self.task_tree.root.expand()
         yield self.task_tree
@@ -195,105 +311,152 @@ class Gui(App):
         self.title = "Title"
         self.subtitle = "subtitle"
 
+        # Redraw only when the workflow or the GUI logger reports a change
+        self.loop = asyncio.get_running_loop()
+        self.dirty = asyncio.Event()
+        self.pending = False
+        self.workflow.subscribe(self.schedule_refresh)
+
         self.create_logger()
         self.logger.info("This is an info test.")
         self.logger.warning("This is a warning test.")
-        #self.load_workflow()
-        # Create a logger and connect it to the message queue
-        # self.create_logger()
 
-        # Start a GUI-updating function that runs at FPS
-        self.gui = self.set_interval(1 / self.fps, self.update_gui)
-        self.gui.resume()
+        # Sample resource usage in the background at a slower rate, otherwise
+        # it's distracting how fast the numbers change.
+        self.sampler = ResourceSampler(self.workflow, rate=self.sample_rate, listener=self.schedule_refresh)
+        self.sampler.start()
 
-        # # Display resource usage at a slower FPS (2), otherwise it's distracting
-        # # how fast the numbers change.
-        # self.backend_updater = self.set_interval(1 / 2, self.update_backend)
-        # self.backend_updater.resume()
+        self.update_gui()
+        self.schedule_refresh()
 
         # Load the workflow YAML 
         #await self.load_workflow()
 
         # Start running the workflow
-        # self.run_workflow()
+        self.run_workflow()
+
 
+    def on_unmount(self) -> None:
+        self.sampler.stop()
+        self.workflow.close()
 
     def create_logger(self) -> None:
         """Create a logger that sends messages to the queue."""
         self.logger = logging.getLogger(name="gui")
-        handler     = QueuingHandler(message_queue=self.messages, level=self.workflow.log.level)
+        handler     = QueuingHandler(message_queue=self.messages, level=self.workflow.log.level, notify=self.schedule_refresh)
         formatter   = logging.Formatter(self.workflow.log.formatter)
 
         handler.setFormatter(formatter)
         self.logger.addHandler(handler)
         self.logger.debug(f"Logger ready.")
 
-    @work
+    def schedule_refresh(self) -> None:
+        """Schedule a redraw, safe to call from the workflow thread."""
+        if self.pending:
+            return
+        self.pending = True
+        try:
+            self.loop.call_soon_threadsafe(self.dirty.set)
+        except RuntimeError:
+            # The event loop is already closed, the app is exiting
+            pass
+
+    @work(exclusive=True, group="gui")
     async def update_gui(self) -> None:
-        self.update_log()
-        #self.update_tree()
-        #self.update_progress()
-        #self.calculate_resources()
-
-
-    @work
-    async def update_log(self):
-        if not self.messages.empty():
-            message = self.messages.get()
-            self.run_log.write(message)
-        if not self.workflow.messages.empty():
-            message = self.workflow.messages.get()
-            self.run_log.write(message)
-    @work
-    async def update_tree(self):
-        for job in self.workflow.jobs:
-            identifier = job
-            if job not in self.task_tree_lookup:
-                job_node = self.task_tree.root.add(job, expand=True)
-                self.task_tree_lookup[identifier] = job_node
-                self.logger.debug(f"Adding progress bar: {job}")
-                self.progress.add_job(job)
-                #self.progress.refresh(recompose)
-
-                #self.progress.mount(Label(job))
-                #self.progress.mount(ProgressBar())
-                #self.progress.refresh(recompose=True)
-            # else:
-            #     job_node = self.task_tree_lookup[job]
-            # for step in self.workflow.get_steps(job):
-            #     identifier = f"{job}.{step}"
-            #     if identifier not in self.task_tree_lookup:
-            #         step_node = job_node.add(step, expand=True)
-            #         self.task_tree_lookup[identifier] = step_node 
-            #     else:
-            #         step_node = self.task_tree_lookup[identifier]
-            #     for task in self.workflow.get_tasks(job, step):
-            #         identifier = f"{job}.{step}.{task}"
-            #         if identifier not in self.task_tree_lookup: 
-            #             task_label = "{:10} {:5}".format(task, "⏩")
-            #             task_node = step_node.add_leaf(task_label)
-            #             self.task_tree_lookup[identifier] = task_node 
-            #         else:
-            #             task_node = self.task_tree_lookup[identifier]
-
-    @work
-    async def calculate_resources(self):
-        now = datetime.now()
-        self.backend.fps = 1/ (now - self.backend.fps_time).total_seconds() 
-        self.backend.fps_time = now
-        self.backend.memory = psutil.virtual_memory().used >> 20
-        self.backend.threads = threading.active_count()
-        self.backend.concurrent = len(asyncio.all_tasks())
-        self.backend.messages = self.messages.qsize()
-        self.backend.tasks = len(self.workflow.tasks)
-
-    @work
-    async def update_backend(self):
-        self.backend.refresh(recompose=True)
-
-    @work
-    async def update_progress(self):
-        pass
+        """
+        Redraw the widgets affected by changes, sleeping while idle.
+
+        Bursts of changes are coalesced into at most fps redraws per second.
+        """
+        interval = 1 / self.fps
+        while True:
+            await self.dirty.wait()
+            self.dirty.clear()
+            self.pending = False
+            start = time.monotonic()
+
+            self.backend.tick()
+            events, _ = self.drain(self.workflow.events)
+            self.update_log()
+            if self.sampler.latest is not self.backend.snapshot:
+                self.update_backend()
+            if events or self.workflow.events.dropped != self.events_dropped:
+                self.update_tree(events)
+                self.update_progress(events)
+                self.events_dropped = self.workflow.events.dropped
+
+            await asyncio.sleep(max(0, interval - (time.monotonic() - start)))
+
+    def drain(self, messages:DropOldestQueue, budget:int=None) -> tuple:
+        """
+        Take every available message off a queue, keeping only the newest budget of them.
+
+        Returns the kept messages and the number of messages dropped.
+        """
+        batch, total = collections.deque(maxlen=budget), 0
+        # Only what is available now, so a fast producer can't keep us here
+        for _ in range(messages.qsize()):
+            try:
+                batch.append(messages.get_nowait())
+                total += 1
+            except queue.Empty:
+                break
+        return (list(batch), total - len(batch))
+
+    def update_log(self):
+        batch, dropped = [], 0
+        for messages in [self.messages, self.workflow.messages]:
+            drained, count = self.drain(messages, self.log_budget)
+            batch.extend(drained)
+            dropped += count
+        if len(batch) > self.log_budget:
+            dropped += len(batch) - self.log_budget
+            batch = batch[-self.log_budget:]
+        if not batch and not dropped:
+            return
+
+        lines = [Text(message) for message in batch]
+        if dropped:
+            self.dropped += dropped
+            lines.insert(0, Text(f"... {dropped} messages dropped", style="bold yellow"))
+            self.query_one("#right-label", Label).update(f"Dropped: {self.dropped}")
+        self.run_log.write(Text("\n").join(lines))
+
+    def update_tree(self, events:list):
+        self.task_tree.apply(events)
+        if self.workflow.events.dropped != self.events_dropped:
+            self.task_tree.reconcile({**self.workflow.tasks, **self.workflow.failed}, self.workflow.tree)
+
+    def update_backend(self):
+        """Show the latest resource snapshot, a plain read of the sampler's attribute."""
+        self.backend.show(
+            self.sampler.latest,
+            concurrent=len(self.workflow.running),
+            messages=(self.messages.qsize() + self.workflow.messages.qsize(), self.messages.dropped + self.workflow.messages.dropped),
+            events=(self.workflow.events.qsize(), self.workflow.events.dropped),
+            tasks=self.workflow.completed + len(self.workflow.tasks),
+        )
+
+    def update_progress(self, events:list):
+        """
+        Refresh the progress of the jobs named by events from the workflow counters.
+
+        Events may be coalesced or dropped, so they only say which rows to
+        refresh, the counts come from the workflow itself.
+        """
+        jobs = set()
+        for event in events:
+            if event.type == EventType.ADD and event.parent == None:
+                self.logger.debug(f"Adding progress bar: {event.identifier}")
+                self.progress.add_job(event.identifier, total=self.job_totals[event.identifier])
+            elif event.leaf:
+                jobs.add(self.workflow.tree[event.identifier.rsplit(".", 1)[0]].job)
+        if self.workflow.events.dropped != self.events_dropped:
+            jobs = self.progress.names
+        for job in jobs:
+            self.progress.set_completed(job, self.workflow.finished[job])
+        results = self.workflow.results
+        self.progress.set_counts(len(self.workflow.running), results[TaskResult.PASS], results[TaskResult.FAIL])
         #self.progress.text = "Updated"
         #self.progress.bars["default"].advance(1)
 
@@ -307,7 +470,7 @@ class Gui(App):
 
     @work(thread=True)
     async def run_workflow(self) -> None:
-        tasks = self.workflow.run_workflow(log_name='gui')
+        await self.workflow.run_workflow()
         # for task in asyncio.as_completed(self.workflow.task_queue):
         #     self.logger.info(f"Waiting for task: {task}")
         #     result = await task
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import asyncio
+import sys
+import time
+
+from workflow import Workflow, TaskResult
+
+
+class Headless:
+    def __init__(self, workflow:Workflow, interval:float=1.0, stream=sys.stdout):
+        """
+        Run a workflow without a TUI, printing compact progress lines.
+
+        Lines are key=value pairs, printed at most once per interval seconds
+        and only when progress changed, so they are cheap to produce and easy
+        to grep in CI logs.
+        """
+        self.workflow = workflow
+        self.interval = interval
+        self.stream   = stream
+        self.total    = sum(node.weight for node in workflow.tree.values() if node.step != None)
+        self.start    = None
+        self.last     = None
+
+    def line(self, kind:str, **fields) -> None:
+        self.stream.write(" ".join([kind] + [f"{k}={v}" for k,v in fields.items()]) + "\n")
+        self.stream.flush()
+
+    def progress(self, force:bool=False) -> None:
+        workflow = self.workflow
+        state = (workflow.completed, len(workflow.running))
+        if state == self.last and not force:
+            return
+        self.last = state
+        elapsed = time.monotonic() - self.start
+        self.line(
+            "progress",
+            elapsed=f"{elapsed:.1f}s",
+            done=f"{workflow.completed}/{max(self.total, workflow.completed)}",
+            passed=workflow.results[TaskResult.PASS],
+            failed=workflow.results[TaskResult.FAIL],
+            cancelled=workflow.results[TaskResult.CANCELLED],
+            running=len(workflow.running),
+            rate=f"{workflow.completed / elapsed if elapsed > 0 else 0:.1f}/s",
+        )
+
+    async def report(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self.progress()
+
+    async def run_workflow(self) -> int:
+        """Run the workflow, returns the exit status: 0 if every step and task passed, 1 otherwise."""
+        self.start = time.monotonic()
+        self.line("start", workflow=self.workflow.name, tasks=self.total, concurrency=self.workflow.concurrency)
+        reporter = asyncio.create_task(self.report())
+        try:
+            await self.workflow.run_workflow()
+        finally:
+            reporter.cancel()
+        self.progress(force=True)
+        for name,task in self.workflow.failed.items():
+            if task.result == TaskResult.FAIL:
+                self.line("fail", task=name, return_code=task.return_code, error=repr(task.error))
+        for name,error in self.workflow.errors.items():
+            self.line("fail", step=name, error=repr(error))
+        for name in self.workflow.skipped:
+            self.line("skip", step=name)
+        failed = self.workflow.results[TaskResult.FAIL] + len(self.workflow.errors)
+        self.line("done", status="fail" if failed else "pass", failed=failed)
+        return 1 if failed else 0
+
+    def run(self) -> int:
+        return asyncio.run(self.run_workflow())
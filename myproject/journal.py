@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+import atexit
+from datetime import datetime
+import json
+import os
+import queue
+import threading
+import time
+
+
+class Journal:
+    def __init__(self, directory:str, run_id:str=None, workflow:str=None, batch:int=100, interval:float=1.0):
+        """
+        An append-only JSONL journal of task status transitions for a run.
+
+        Records are queued and a writer thread writes them with a single
+        fsync per batch of up to batch records or interval seconds, so the
+        event loop never waits on the disk and a crash loses at most the
+        last batch. Passing the run_id of an earlier run appends to its
+        journal, so the run can be resumed. A new journal starts with a
+        header record naming the workflow it belongs to.
+        """
+        self.directory = directory
+        self.run_id    = run_id if run_id != None else datetime.now().strftime("%Y%m%d-%H%M%S-") + str(os.getpid())
+        self.path      = os.path.join(directory, f"{self.run_id}.jsonl")
+        self.batch     = batch
+        self.interval  = interval
+        self.records   = queue.SimpleQueue()
+        self.stopped   = False
+        os.makedirs(directory, exist_ok=True)
+        self.file   = open(self.path, "a")
+        if workflow != None and self.file.tell() == 0:
+            self.records.put_nowait(dict(workflow=workflow, time=time.time()))
+        self.writer = threading.Thread(target=self.write, name="journal-writer", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    @staticmethod
+    def load(directory:str, run_id:str) -> dict:
+        """Return the latest record of each task in the journal of run_id."""
+        path = os.path.join(directory, f"{run_id}.jsonl")
+        if not os.path.exists(path):
+            raise Exception(f"No journal found for run '{run_id}': {path}")
+        records = {}
+        with open(path) as infile:
+            for line in infile:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn final line from a crash
+                    continue
+                if "task" in record:
+                    records[record["task"]] = record
+        return records
+
+    @staticmethod
+    def header(path:str) -> dict:
+        """Return the header record of a journal, empty if it has none."""
+        with open(path) as infile:
+            try:
+                record = json.loads(infile.readline())
+            except ValueError:
+                return {}
+        return record if "workflow" in record else {}
+
+    @staticmethod
+    def durations(directory:str, workflow:str, runs:int=10) -> dict:
+        """
+        Return the mean duration in seconds of the tasks of each step, from the newest runs journals of workflow.
+
+        Only tasks that ran count, tasks restored from a journal or the cache
+        have no RUNNING record. Journals of other workflows, or without a
+        header, are ignored: their steps may share names but not durations.
+        """
+        if not os.path.isdir(directory):
+            return {}
+        paths = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".jsonl")]
+        paths = sorted(paths, key=os.path.getmtime, reverse=True)
+        paths = [path for path in paths if Journal.header(path).get("workflow") == workflow][0:runs]
+        totals, counts = {}, {}
+        for path in paths:
+            started = {}
+            with open(path) as infile:
+                for line in infile:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if "task" not in record:
+                        continue
+                    elif record["status"] == "RUNNING":
+                        started[record["task"]] = record["time"]
+                    elif record["task"] in started:
+                        step = record["task"].rsplit(".", 1)[0]
+                        totals[step] = totals.get(step, 0) + record["time"] - started.pop(record["task"])
+                        counts[step] = counts.get(step, 0) + 1
+        return {step:totals[step] / counts[step] for step in totals}
+
+    def record(self, task:str, status:str, **fields) -> None:
+        """Queue a record for the writer thread, never blocks."""
+        self.records.put_nowait(dict(task=task, status=status, time=time.time(), **fields))
+
+    def write(self) -> None:
+        """Write and sync batches of queued records, until the None sentinel of close()."""
+        running = True
+        while running:
+            items = [self.records.get()]
+            deadline = time.monotonic() + self.interval
+            # A flush() waits on an Event, write what is queued before it without waiting out the interval
+            while len(items) < self.batch and type(items[-1]) == dict:
+                try:
+                    items.append(self.records.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            records = [item for item in items if type(item) == dict]
+            if records:
+                self.file.write("".join(json.dumps(record) + "\n" for record in records))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            for item in items:
+                if item == None:
+                    running = False
+                elif type(item) == threading.Event:
+                    item.set()
+
+    def flush(self) -> None:
+        """Wait until the queued records are written and synced, from a thread other than the event loop."""
+        if self.writer.is_alive():
+            written = threading.Event()
+            self.records.put(written)
+            written.wait()
+
+    def close(self) -> None:
+        """Write the queued records and close the journal."""
+        if self.stopped:
+            return
+        self.stopped = True
+        if self.writer.is_alive():
+            self.records.put(None)
+            self.writer.join()
+        self.file.close()
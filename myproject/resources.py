@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import collections
+import threading
+import time
+
+import psutil
+
+# Resource usage of a task process and its children
+Sample = collections.namedtuple("Sample", ["cpu", "rss", "read_bytes", "write_bytes", "fds"])
+# Everything the Backend panel needs, replaced as a whole on each sample
+Snapshot = collections.namedtuple("Snapshot", ["time", "threads", "memory", "tasks", "steps"])
+
+class ResourceSampler(threading.Thread):
+    def __init__(self, workflow, rate:float=2, history:int=60, listener=None):
+        """
+        Sample the resources of running task processes in a background thread.
+
+        Every 1/rate seconds the CPU%, RSS, IO bytes and open file descriptors
+        of each running subprocess (and its children) are collected with
+        psutil, appended to a fixed-size ring buffer per task, and published
+        as a new immutable Snapshot in self.latest. Readers never lock, they
+        just read self.latest.
+        """
+        super().__init__(name="resource-sampler", daemon=True)
+        self.workflow  = workflow
+        self.interval  = 1 / rate
+        self.history   = collections.OrderedDict()
+        self.length    = history
+        self.listener  = listener
+        self.processes = {}
+        self.latest    = Snapshot(time.time(), threading.active_count(), 0, {}, {})
+        self.stopped   = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.sample()
+            if self.listener != None:
+                self.listener()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def process(self, pid:int) -> psutil.Process:
+        """Return a cached Process, cpu_percent() measures since the previous call on it."""
+        if pid not in self.processes:
+            self.processes[pid] = psutil.Process(pid)
+            self.processes[pid].cpu_percent()
+        return self.processes[pid]
+
+    def measure(self, pid:int) -> Sample:
+        cpu, rss, read_bytes, write_bytes, fds = 0.0, 0, 0, 0, 0
+        try:
+            parent = self.process(pid)
+            processes = [parent] + [self.process(c.pid) for c in parent.children(recursive=True)]
+        except psutil.Error:
+            return None
+        for proc in processes:
+            try:
+                with proc.oneshot():
+                    cpu += proc.cpu_percent()
+                    rss += proc.memory_info().rss
+                    if hasattr(proc, "io_counters"):
+                        io = proc.io_counters()
+                        read_bytes  += io.read_bytes
+                        write_bytes += io.write_bytes
+                    if hasattr(proc, "num_fds"):
+                        fds += proc.num_fds()
+            except psutil.Error:
+                continue
+        return Sample(cpu, rss, read_bytes, write_bytes, fds)
+
+    def sample(self) -> None:
+        tasks, steps, seen = {}, {}, set()
+        for task in list(self.workflow.running.values()):
+            if task.pid == None:
+                continue
+            sample = self.measure(task.pid)
+            if sample == None:
+                continue
+            seen.add(task.pid)
+            tasks[task.name] = sample
+            if task.name not in self.history:
+                self.history[task.name] = collections.deque(maxlen=self.length)
+            self.history[task.name].append(sample)
+            self.history.move_to_end(task.name)
+            # Aggregate by step, to find which step is eating the box
+            step = task.name.rsplit(".", 1)[0]
+            steps[step] = Sample(*[a + b for a,b in zip(steps[step], sample)]) if step in steps else sample
+
+        # Forget processes that have exited, and the oldest finished tasks
+        for pid in [pid for pid,proc in self.processes.items() if not proc.is_running()]:
+            del self.processes[pid]
+        while len(self.history) > max(self.length, len(tasks)):
+            self.history.popitem(last=False)
+
+        memory = psutil.virtual_memory().used
+        self.latest = Snapshot(time.time(), threading.active_count(), memory, tasks, steps)
@@ -1,16 +1,38 @@
 #!/usr/bin/env/python3
 
-import asyncio
+# The heavier modules (asyncio, ast, yaml) are imported in the methods that
+# use them, so --help doesn't pay for them and validating a workflow doesn't
+# import asyncio.
+import atexit
+import builtins
+import collections
+import contextlib
 from collections import OrderedDict
-import yaml
 import time
-from typing import List
+from collections.abc import Iterator
 
-import argparse
 import enum
+import functools
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import marshal
+import math
+import os
 import queue
+import re
+import resource
+import shlex
+import shutil
+import signal
+import sys
+import threading
 
+from cache import ResultCache
+from journal import Journal
+from executor import Executor, ExecutorType, IsolatedExecutor, create_executor
 
 class Display(enum.IntEnum):
     GUI = 1
@@ -29,6 +51,693 @@ class Display(enum.IntEnum):
         except KeyError:
             return s
 
+class Expression:
+    # Names that expressions may use when running in safe mode
+    builtins = {name:getattr(builtins, name) for name in [
+        "abs", "all", "any", "bool", "chr", "dict", "divmod", "enumerate",
+        "filter", "float", "frozenset", "int", "isinstance", "len", "list",
+        "map", "max", "min", "ord", "pow", "print", "range", "reversed",
+        "round", "set", "slice", "sorted", "str", "sum", "tuple", "zip",
+    ]}
+    modules = {"math": math, "time": time}
+    # Attributes that can be used to walk out of the sandbox
+    blocked_attributes = {"format", "format_map", "mro"}
+    # Generator, coroutine, frame, traceback and code attributes lead to the globals of callers
+    blocked_prefixes = ("_", "gi_", "cr_", "ag_", "f_", "tb_", "co_")
+
+    def __init__(self, source:str, safe:bool=True):
+        """
+        A python expression, parsed into an AST and compiled once.
+
+        In safe mode the AST is validated against an allow-list of names,
+        and private or dunder attribute access is rejected. Use
+        Expression.get() to share compiled expressions keyed by source text.
+
+        >>> Expression.get("max(x * 2 for x in range(3))").evaluate()
+        4
+        """
+        import ast
+        self.source = source
+        self.safe   = safe
+        tree = ast.parse(source.strip(), mode="eval")
+        if safe:
+            self.validate(tree)
+        self.code = compile(tree, "<expression>", "eval")
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def get(source:str, safe:bool=True) -> "Expression":
+        """Return the compiled Expression of source, compiling it on first use."""
+        return Expression(source, safe)
+
+    def validate(self, tree:"ast.AST") -> None:
+        import ast
+        allowed = set(self.builtins) | set(self.modules)
+        # Names bound inside the expression by comprehensions and lambdas
+        for node in ast.walk(tree):
+            if isinstance(node, ast.comprehension):
+                allowed.update(n.id for n in ast.walk(node.target) if isinstance(n, ast.Name))
+            elif isinstance(node, ast.Lambda):
+                allowed.update(a.arg for a in ast.walk(node.args) if isinstance(a, ast.arg))
+
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and node.id not in allowed:
+                raise Exception(f"Name `{node.id}` is not allowed in safe mode: {self.source}")
+            elif isinstance(node, ast.Attribute) and (node.attr.startswith(self.blocked_prefixes) or node.attr in self.blocked_attributes):
+                raise Exception(f"Attribute `{node.attr}` is not allowed in safe mode: {self.source}")
+
+    def evaluate(self):
+        g = {"__builtins__": self.builtins if self.safe else builtins, **self.modules}
+        return eval(self.code, g)
+
+    def __repr__(self):
+        return self.source
+
+def parse_size(size) -> int:
+    """
+    Parse a size in bytes, with an optional K, M, G or T suffix (powers of 1024).
+
+    >>> parse_size("512M")
+    536870912
+    """
+    if size == None:
+        return None
+    size = str(size).strip().upper().rstrip("B")
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+class LimitExceeded(Exception):
+    pass
+
+class Limits:
+    def __init__(self, data:dict=None):
+        """
+        Resource limits declared by a step with the 'limits:' key.
+
+        memory (bytes, address space), cpu (seconds) and files (open file
+        descriptors) are enforced with setrlimit() in the process running the
+        task. timeout (seconds of wall time) is enforced by the scheduler.
+        """
+        data = data if data != None else {}
+        unknown = set(data) - {"memory", "cpu", "files", "timeout"}
+        if unknown:
+            raise Exception(f"Unknown limits: {', '.join(sorted(unknown))}")
+        self.memory  = parse_size(data.get("memory"))
+        self.cpu     = int(data["cpu"]) if data.get("cpu") != None else None
+        self.files   = int(data["files"]) if data.get("files") != None else None
+        self.timeout = float(data["timeout"]) if data.get("timeout") != None else None
+
+    @staticmethod
+    def from_step(data:dict) -> "Limits":
+        """Return the limits of a step or task spec, with the timeout: shorthand of its limits."""
+        limits = Limits(data.get("limits"))
+        if data.get("timeout") != None:
+            if limits.timeout != None:
+                raise Exception("timeout is declared both in the step and in its limits")
+            limits.timeout = float(data["timeout"])
+        return limits
+
+    def rlimits(self) -> dict:
+        """Return the soft limits to apply, by resource."""
+        rlimits = {}
+        if self.memory != None:
+            rlimits[resource.RLIMIT_AS] = self.memory
+        if self.cpu != None:
+            rlimits[resource.RLIMIT_CPU] = self.cpu
+        if self.files != None:
+            rlimits[resource.RLIMIT_NOFILE] = self.files
+        return rlimits
+
+    def apply(self) -> None:
+        """
+        Apply the limits to the current process, which must run a single task.
+
+        Used as the preexec_fn of subprocesses and by the processes of the
+        isolated executor. CPU time gets a hard limit one second above the
+        soft one: SIGXCPU can be handled, or deferred by a long C call, the
+        SIGKILL at the hard limit can't.
+        """
+        for limit,value in self.rlimits().items():
+            hard = resource.getrlimit(limit)[1]
+            if limit == resource.RLIMIT_CPU:
+                hard = value + 1 if hard == resource.RLIM_INFINITY else min(value + 1, hard)
+            else:
+                hard = value
+            resource.setrlimit(limit, (value, hard))
+
+    def cpu_exceeded(self, signum, frame):
+        raise LimitExceeded(f"CPU time limit of {self.cpu}s exceeded")
+
+    def __bool__(self):
+        return bool(self.rlimits()) or self.timeout != None
+
+def evaluate(source:str, safe:bool=True, limits:Limits=None):
+    """
+    Evaluate an expression, a module-level function so it can be sent to a process pool.
+
+    Limits are only passed in a process of its own, see IsolatedExecutor.
+    """
+    if limits:
+        limits.apply()
+        signal.signal(signal.SIGXCPU, limits.cpu_exceeded)
+    return Expression.get(source, safe).evaluate()
+
+def executor_kind(data:dict, limits:Limits=None, default:ExecutorType=ExecutorType.THREAD) -> ExecutorType:
+    """
+    Return the executor backend a task runs on.
+
+    Function steps with resource limits or a timeout run in a process of
+    their own, so the limits don't apply to the workflow or to a reused pool
+    worker, and a task that times out is killed instead of holding a worker.
+    """
+    if limits:
+        return ExecutorType.ISOLATED
+    elif "executor" in data:
+        return ExecutorType.argparse(str(data["executor"]))
+    return default
+
+# Characters and words that need a shell to be interpreted
+SHELL_METACHARACTERS = set("|&;<>()$`\\*?[]#~{}!")
+SHELL_WORDS = {
+    ".", ":", "alias", "break", "case", "cd", "continue", "do", "done", "elif", "else",
+    "esac", "eval", "exec", "exit", "export", "fi", "for", "function", "if", "read",
+    "readonly", "return", "set", "shift", "source", "then", "trap", "ulimit", "umask",
+    "unset", "until", "wait", "while",
+}
+
+@functools.lru_cache(maxsize=4096)
+def parse_command(command:str) -> tuple:
+    """
+    Parse a multi-line shell block into a tuple of argument lists, one per line.
+
+    Returns None if any line needs a shell: metacharacters, variable
+    assignments, shell builtins, or programs that are not on the PATH.
+
+    >>> parse_command("echo test1\\necho 'test 2'")
+    (('echo', 'test1'), ('echo', 'test 2'))
+    """
+    argvs = []
+    for line in command.split("\n"):
+        line = line.strip()
+        if line == "":
+            continue
+        if SHELL_METACHARACTERS.intersection(line):
+            return None
+        try:
+            argv = shlex.split(line)
+        except ValueError:
+            return None
+        if "=" in argv[0] or argv[0] in SHELL_WORDS or shutil.which(argv[0]) == None:
+            return None
+        argvs.append(tuple(argv))
+    return tuple(argvs) if argvs else None
+
+class TaskStatus(enum.Enum):
+    PENDING = 1
+    RUNNING = 2
+    COMPLETE = 3
+
+    def __repr__(self):
+        return str(self)
+
+class TaskResult(enum.Enum):
+    UNKNOWN = 1
+    PASS = 2
+    FAIL = 3
+    CANCELLED = 4
+
+    def __repr__(self):
+        return str(self)
+
+class FailurePolicy(enum.IntEnum):
+    # Run every task regardless of failures
+    KEEP_GOING = 1
+    # Cancel the outstanding tasks at the first failure
+    FAIL_FAST = 2
+
+    def __str__(self):
+        return self.name.lower()
+
+    def __repr__(self):
+        return str(self)
+
+    @staticmethod
+    def argparse(s):
+        try:
+            return FailurePolicy[s.upper().replace("-", "_")]
+        except KeyError:
+            return s
+
+class Task:
+    # Size of the chunks read from a subprocess pipe, and the longest line kept whole
+    chunk_size = 1 << 16
+
+    def __init__(
+        self,
+        name:str,
+        data:dict,
+        safe:bool=True,
+        executor:Executor=None,
+        log:"Log"=None,
+        logger:logging.Logger=None,
+        limits:Limits=None,
+        remote=None,
+    ):
+        """
+        A single expanded task of a workflow step.
+
+        A task with a remote Coordinator is run by a remote worker instead.
+        """
+        self.name        = name
+        self.safe        = safe
+        self.executor    = executor
+        self.limits      = limits if limits != None else Limits()
+        self.log         = log if log != None else Log()
+        self.logger      = logger if logger != None else logging.getLogger(self.log.name)
+        self.data        = data
+        self.status      = TaskStatus.PENDING
+        self.result      = TaskResult.UNKNOWN
+        self.stdout      = None
+        self.stderr      = None
+        self.output      = None
+        self.error       = None
+        self.return_code = None
+        self.future      = None
+        self.pid         = None
+        self.log_files   = {}
+        self.cache_key   = None
+        self.cached      = False
+        self.attempts    = 0
+        self.remote      = remote
+        # Called with (stream name, line) for every line of output
+        self.listener    = None
+
+    def command(self) -> str:
+        """Return the shell command of the task, or None if it is not a shell task."""
+        run_data = self.data.get("run", self.data.get("command"))
+        return run_data if type(run_data) == str else None
+
+    def function(self) -> str:
+        """Return the python expression of the task, or None if it is not a function task."""
+        if "function" in self.data:
+            return str(self.data["function"])
+        run_data = self.data.get("run")
+        if isinstance(run_data, dict) and "function" in run_data:
+            return str(run_data["function"])
+        return None
+
+    def files(self, key:str) -> list[str]:
+        files = self.data.get(key)
+        if files == None:
+            return []
+        return [str(files)] if isinstance(files, str) else [str(f) for f in files]
+
+    def inputs(self) -> list[str]:
+        """Return the declared input files of the task, part of its cache key."""
+        return self.files("inputs")
+
+    def outputs(self) -> list[str]:
+        """Return the declared output files of the task, stored in and restored from the cache."""
+        return self.files("outputs")
+
+    def cacheable(self) -> bool:
+        return self.data.get("cache", True) not in [False, "false", "False"]
+
+    def record(self) -> dict:
+        """Return the result of the task, as stored in the cache."""
+        return {
+            "return_code": self.return_code,
+            "result":      self.result.name,
+            "stdout":      self.stdout,
+            "stderr":      self.stderr,
+        }
+
+    def restore(self, record:dict) -> None:
+        """Restore the result of the task from a cache or journal record, instead of running it."""
+        self.return_code = record["return_code"]
+        self.result      = TaskResult[record["result"]]
+        self.stdout      = record.get("stdout", "")
+        self.stderr      = record.get("stderr", "")
+        self.status      = TaskStatus.COMPLETE
+        self.cached      = True
+
+    async def run(self, pass_codes=[0]):
+        import asyncio
+        self.attempts   += 1
+        self.status      = TaskStatus.RUNNING
+        self.result      = TaskResult.UNKNOWN
+        self.output      = None
+        self.error       = None
+        self.return_code = None
+        self.stdout      = None
+        self.stderr      = None
+        try:
+            # Remote tasks are timed by the worker once they start, not while they are queued
+            await asyncio.wait_for(self.execute(), timeout=self.limits.timeout if self.remote == None else None)
+        except asyncio.TimeoutError:
+            self.error = f"Timed out after {self.limits.timeout}s"
+            self.return_code = 1
+        except Exception as e:
+            self.error = repr(e)
+            self.return_code = 1
+
+        self.status = TaskStatus.COMPLETE
+
+        if self.return_code in pass_codes:
+            self.result = TaskResult.PASS
+        else:
+            self.result = TaskResult.FAIL
+
+    async def execute(self) -> None:
+        command, function = self.command(), self.function()
+        if self.remote != None:
+            await self.remote.execute(self)
+        elif command != None:
+            await self.run_command(command)
+        elif function != None:
+            limits = self.limits if self.limits.rlimits() and isinstance(self.executor, IsolatedExecutor) else None
+            if self.executor != None:
+                self.output = await self.executor.run(evaluate, function, self.safe, limits)
+            else:
+                self.output = evaluate(function, self.safe, limits)
+            self.stdout = str(self.output)
+            self.return_code = 0
+        else:
+            self.return_code = 0
+
+    async def run_command(self, command:str) -> None:
+        """
+        Run a shell step, launching simple lines directly without an intermediate shell.
+
+        A block that needs shell features is run by a single shell invocation.
+        The return code is that of the last command, as it would be in a shell.
+        """
+        import asyncio
+        argvs = parse_command(command)
+        tails = {name:collections.deque(maxlen=self.log.tail) for name in ["stdout", "stderr"]}
+        files = {}
+        if self.log.task_dir:
+            os.makedirs(self.log.task_dir, exist_ok=True)
+            for name in tails:
+                self.log_files[name] = os.path.join(self.log.task_dir, f"{self.name}.{name}.log")
+                files[name] = open(self.log_files[name], "wb")
+
+        preexec_fn = self.limits.apply if self.limits.rlimits() else None
+        try:
+            for argv in (argvs if argvs != None else [None]):
+                if argv == None:
+                    proc = await asyncio.create_subprocess_shell(
+                        command,
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE,
+                        preexec_fn=preexec_fn,
+                        start_new_session=True)
+                else:
+                    proc = await asyncio.create_subprocess_exec(
+                        *argv,
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE,
+                        preexec_fn=preexec_fn,
+                        start_new_session=True)
+                self.pid = proc.pid
+                try:
+                    await asyncio.gather(*[
+                        self.stream(getattr(proc, name), name, tails[name], files.get(name))
+                        for name in tails
+                    ])
+                    self.return_code = await proc.wait()
+                except asyncio.CancelledError:
+                    # Timed out or cancelled, don't leave the process or its children running
+                    if proc.returncode == None:
+                        with contextlib.suppress(ProcessLookupError):
+                            os.killpg(proc.pid, signal.SIGKILL)
+                        await proc.wait()
+                    raise
+        finally:
+            for outfile in files.values():
+                outfile.close()
+
+        if tails["stdout"]:
+            self.stdout = "\n".join(tails["stdout"]).strip()
+        if tails["stderr"]:
+            self.stderr = "\n".join(tails["stderr"]).strip()
+
+    async def stream(self, reader:"asyncio.StreamReader", name:str, tail:collections.deque, outfile=None) -> None:
+        """
+        Read a subprocess pipe incrementally, line by line.
+
+        Every line is forwarded to the logger as it arrives and appended to
+        tail, a bounded buffer. The full stream is written to outfile.
+        """
+        def emit(line:bytes) -> None:
+            line = line.decode(errors="replace").rstrip("\r")
+            tail.append(line)
+            self.logger.info(f"{self.name} [{name}] {line}")
+            if self.listener != None:
+                self.listener(name, line)
+
+        partial = b""
+        while True:
+            chunk = await reader.read(self.chunk_size)
+            if not chunk:
+                break
+            if outfile:
+                outfile.write(chunk)
+            lines = (partial + chunk).split(b"\n")
+            partial = lines.pop()
+            for line in lines:
+                emit(line)
+            # Don't let a single endless line grow without bound
+            if len(partial) >= self.chunk_size:
+                emit(partial)
+                partial = b""
+        if partial:
+            emit(partial)
+
+    def summary(self):
+        msg = self.name
+        if self.status in [TaskStatus.PENDING, TaskStatus.RUNNING]:
+            msg += f" | status: {self.status.name}"
+        elif self.status == TaskStatus.COMPLETE:
+            msg += f" | result: {self.result.name} | return_code: {self.return_code}"
+            if self.result == TaskResult.FAIL:
+                msg += f" | error: {self.error if self.error else self.stderr}"
+            elif self.result == TaskResult.PASS:
+                msg += f" | stdout: {self.stdout}"
+        return msg
+
+    def __repr__(self):
+        return self.name
+
+class FrozenDict(dict):
+    """An immutable dict, so task specs can share unchanged subtrees by reference."""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError(f"'{type(self).__name__}' object is immutable")
+
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+def freeze(data):
+    """Recursively convert dicts to FrozenDict and lists to tuples."""
+    if isinstance(data, dict):
+        return data if type(data) == FrozenDict else FrozenDict((k, freeze(v)) for k,v in data.items())
+    elif isinstance(data, (list, tuple)):
+        return tuple(freeze(v) for v in data)
+    return data
+
+class Template:
+    # Escaped braces, or a {variable} placeholder
+    regex = re.compile(r"\{\{|\}\}|\{([A-Za-z0-9_]+)\}")
+
+    def __init__(self, data, parent=None):
+        """
+        Compile data into a template tree, recording which leaves contain placeholders.
+
+        Strings are split once into a list of literal segments, with the
+        placeholder positions stored in self.slots. Subtrees without any
+        placeholders are frozen once and shared by reference between every
+        rendered spec, only templated leaves are materialized per render.
+
+        >>> Template({"run": "echo {x}", "n": 1}).render({"x": "Hello"})
+        {'run': 'echo Hello', 'n': 1}
+        """
+        self.data      = data
+        self.parent    = parent
+        self.segments  = None
+        self.slots     = []
+        self.children  = None
+        self.variables = set()
+        self.dynamic   = False
+
+        if type(data) == dict:
+            self.children = [(k, Template(v, parent=k)) for k,v in data.items()]
+        elif type(data) == list:
+            self.children = [(i, Template(v, parent=parent)) for i,v in enumerate(data)]
+        elif type(data) == str:
+            self.segments, end = [], 0
+            for match in self.regex.finditer(data):
+                self.dynamic = True
+                self.segments.append(data[end:match.start()])
+                var = match.group(1)
+                if var == None:
+                    self.segments.append(match.group()[0])
+                else:
+                    self.slots.append((len(self.segments), var))
+                    self.segments.append(None)
+                    self.variables.add(var)
+                end = match.end()
+            self.segments.append(data[end:])
+
+        if self.children != None:
+            for _,child in self.children:
+                self.dynamic = self.dynamic or child.dynamic
+                self.variables.update(child.variables)
+        if not self.dynamic:
+            self.data = freeze(data)
+
+    def render(self, vars:dict, allow_missing=False):
+        """Render the template with the variables in vars."""
+        if not self.dynamic:
+            return self.data
+        elif self.segments != None:
+            segments = list(self.segments)
+            for i,var in self.slots:
+                if var in vars:
+                    segments[i] = str(vars[var])
+                elif allow_missing:
+                    segments[i] = f"{{{var}}}"
+                else:
+                    raise Exception(f"Undefined format variable `{var}` in {self.parent} = {self.data}")
+            return "".join(segments)
+        elif type(self.data) == dict:
+            return FrozenDict((k, t.render(vars, allow_missing) if t.dynamic else t.data) for k,t in self.children)
+        else:
+            return tuple(t.render(vars, allow_missing) if t.dynamic else t.data for _,t in self.children)
+
+class EventType(enum.IntEnum):
+    ADD = 1
+    UPDATE = 2
+    REMOVE = 3
+
+    def __str__(self):
+        return self.name.lower()
+
+# A diff of the workflow tree published by the engine: a job, step or task
+# node added under parent, updated with a new status, or removed.
+Event = collections.namedtuple(
+    "Event",
+    ["type", "identifier", "status", "result", "parent", "leaf"],
+    defaults=[None, None, None, False],
+)
+
+class DropOldestQueue:
+    def __init__(self, maxsize:int=10000):
+        """
+        A thread safe bounded queue that drops its oldest item when full.
+
+        Has the put/get_nowait/qsize subset of queue.Queue, and counts the
+        items dropped so overflow is visible.
+        """
+        self.maxsize = maxsize
+        self.items   = collections.deque()
+        self.lock    = threading.Lock()
+        self.dropped = 0
+
+    def put(self, item) -> None:
+        with self.lock:
+            if len(self.items) >= self.maxsize:
+                self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+
+    def get_nowait(self):
+        with self.lock:
+            if not self.items:
+                raise queue.Empty
+            return self.items.popleft()
+
+    def qsize(self) -> int:
+        return len(self.items)
+
+class CoalescingQueue(DropOldestQueue):
+    def __init__(self, maxsize:int=100000):
+        """
+        A bounded queue of events that keeps only the latest state of each node.
+
+        An event for a node that already has one queued is merged into it, in
+        its original position, so parents are still added before children.
+        When full, the oldest task event is dropped, preferring tasks that
+        haven't failed; job and step events are always kept.
+        """
+        super().__init__(maxsize)
+        self.items     = OrderedDict()
+        self.coalesced = 0
+
+    def put(self, event:Event) -> None:
+        with self.lock:
+            queued = self.items.get(event.identifier)
+            if queued != None:
+                self.coalesced += 1
+                if queued.type == EventType.ADD and event.type == EventType.UPDATE:
+                    # Never shown, so add it with its latest status
+                    event = queued._replace(status=event.status, result=event.result)
+                self.items[event.identifier] = event
+                return
+            if len(self.items) >= self.maxsize:
+                oldest = None
+                for identifier,queued in self.items.items():
+                    if queued.leaf:
+                        oldest = identifier if oldest == None else oldest
+                        if queued.result != TaskResult.FAIL:
+                            oldest = identifier
+                            break
+                if oldest != None:
+                    del self.items[oldest]
+                    self.dropped += 1
+            self.items[event.identifier] = event
+
+    def get_nowait(self) -> Event:
+        with self.lock:
+            if not self.items:
+                raise queue.Empty
+            return self.items.popitem(last=False)[1]
+
+class Node:
+    def __init__(self, identifier:str, job:str, step:str=None, data:dict=None, order:int=0):
+        """
+        A node of the workflow DAG.
+
+        Step nodes expand into tasks, job nodes are barriers that complete
+        once all of their steps have completed.
+        """
+        self.identifier   = identifier
+        self.job          = job
+        self.step         = step
+        self.data         = data if data != None else {}
+        self.order        = order
+        self.dependencies = set()
+        self.dependents   = set()
+        self.weight       = 0
+        self.priority     = 0
+        self.status       = TaskStatus.PENDING
+        self.result       = None
+        self.tasks        = []
+        self.specs        = None
+        self.running      = 0
+        self.expanded     = False
+        self.limits       = Limits()
+        self.retries      = 0
+        self.backoff      = 1.0
+
+    def __repr__(self):
+        return self.identifier
+
 class Log():
     def __init__(
         self, 
@@ -38,6 +747,8 @@ class Log():
         level          = logging.INFO,
         datefmt        = '%Y-%m-%d %H:%M:%S',
         stdout         = True,
+        task_dir:str   = "logs",
+        tail:int       = 100,
     ):
         self.name      = name
         self.file      = file
@@ -45,114 +756,887 @@ class Log():
         self.level     = level
         self.datefmt   = datefmt
         self.stdout    = stdout
+        self.task_dir  = task_dir
+        self.tail      = tail
 
 class Workflow:
-    def __init__(self, path:str, log:Log=None):
-        """Create a Workflow based on a YAML path"""
+    # Known keys of the workflow, job and step mappings, anything else is a typo.
+    # YAML 1.1 loads an unquoted `on` key as True.
+    workflow_keys = {"name", "on", True, "env", "jobs"}
+    job_keys      = {"steps", "dependency"}
+    step_keys     = {"run", "command", "function", "args", "variables", "dependency", "limits", "executor", "inputs", "outputs", "cache", "retries", "backoff", "timeout"}
+
+    def __init__(
+        self,
+        path:str,
+        log:Log=None,
+        concurrency:int=None,
+        safe:bool=True,
+        executor:ExecutorType=ExecutorType.THREAD,
+        max_memory:str=None,
+        cache:str=None,
+        cache_size:str="1G",
+        journal:str=None,
+        resume:str=None,
+        listen:str=None,
+        policy:FailurePolicy=FailurePolicy.KEEP_GOING,
+    ):
+        """
+        Create a Workflow based on a YAML path
+
+        With listen, an address like host:port or unix:path, tasks are run by
+        remote workers connected to a Coordinator instead of locally.
+        """
         if log != None:
             self.log  = log
         else:
             self.log  = Log()
-        self.logger   = None
-        self.messages = queue.Queue()
-        self.path     = path
-        self.tasks    = OrderedDict()
-        self.tree     = OrderedDict()
+        self.logger      = None
+        self.log_listener = None
+        self.messages    = DropOldestQueue()
+        self.path        = path
+        self.safe        = safe
+        self.concurrency = concurrency if concurrency else os.cpu_count()
+        self.executor    = executor
+        self.executors   = {}
+        self.max_memory  = parse_size(max_memory)
+        self.cache       = ResultCache(cache, max_size=parse_size(cache_size)) if cache else None
+        self.memory_in_use = 0
+        self.journal     = None
+        self.resumed     = {}
+        self.coordinator = None
+        self.policy      = policy
+        self.events      = CoalescingQueue()
+        self.listeners   = []
+        # Tasks in flight, running or waiting for a retry, and those that didn't pass
+        self.tasks       = OrderedDict()
+        self.failed      = OrderedDict()
+        self.running     = {}
+        self.tree        = OrderedDict()
+        self.completed   = 0
+        self.finished    = collections.Counter()
+        self.results     = collections.Counter()
+        self.skipped     = []
+        self.errors      = {}
+        self.throughput  = 0
 
         self.create_logger()
+        self.open_journal(journal, resume)
+        if listen != None:
+            from distributed import Coordinator
+            self.coordinator = Coordinator(listen, self.logger, self.log)
 
-        # with open(path) as infile:
-        #     self.data = yaml.safe_load(infile)
-        # self.name = self.data["name"] if "name" in self.data else "unknown"
-        # self.jobs = self.data["jobs"] if "jobs" in self.data else {}
-        # self.logger = logging.getLogger(name='workflow')
+        self.read()
+        self.validate()
+        self.name = self.data["name"] if "name" in self.data else "unknown"
+        self.jobs = self.data["jobs"] if "jobs" in self.data and self.data["jobs"] != None else {}
+
+        self.build_tree()
+        self.write_parsed()
 
     # def __repr__(self):
     #     return 
 
+    def read(self) -> None:
+        """
+        Load the workflow YAML, with the libyaml loader when it is available.
+
+        The parsed data is cached in a marshal file next to the workflow, keyed
+        by its path, mtime and content hash, so unchanged workflows skip
+        parsing. The cache is written once the workflow has been validated.
+        """
+        with open(self.path, "rb") as infile:
+            content = infile.read()
+        self.parsed_path = os.path.join(os.path.dirname(self.path), f".{os.path.basename(self.path)}.cache")
+        self.parsed_blob = None
+        key = [os.path.abspath(self.path), os.stat(self.path).st_mtime_ns, hashlib.sha256(content).hexdigest()]
+        try:
+            with open(self.parsed_path, "rb") as infile:
+                cached_key, data = marshal.load(infile)
+            if cached_key == key:
+                self.logger.debug(f"Loaded parsed workflow from {self.parsed_path}")
+                self.data = data
+                return
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+
+        import yaml
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+        self.data = yaml.load(content, Loader=loader)
+        try:
+            self.parsed_blob = marshal.dumps([key, self.data])
+        except ValueError:
+            # Types marshal can't store, e.g. YAML timestamps
+            pass
+
+    def write_parsed(self) -> None:
+        """Write the parsed workflow cache, if the workflow was parsed rather than read from it."""
+        if self.parsed_blob == None:
+            return
+        staging = f"{self.parsed_path}.{os.getpid()}"
+        try:
+            with open(staging, "wb") as outfile:
+                outfile.write(self.parsed_blob)
+            os.replace(staging, self.parsed_path)
+        except OSError as e:
+            self.logger.debug(f"Could not write parsed workflow cache {self.parsed_path}: {e}")
+            with contextlib.suppress(OSError):
+                os.remove(staging)
+        self.parsed_blob = None
+
     def create_logger(self) -> None:
-        """Create a logger that sends messages to the queue."""
-        #  Root logger
-        logging.basicConfig(
-            format=self.log.formatter,
-            level=self.log.level,
-            datefmt=self.log.datefmt,
-            filename=self.log.file,
-            filemode='w'
-        )
-        self.logger = logging.getLogger(name=self.log.name)
-        formatter   = logging.Formatter(self.log.formatter, self.log.datefmt)
-    
-        # Add a handler to pass messages to our queue
-        handler = QueuingHandler(message_queue=self.messages, level=self.log.level)
-        handler.setFormatter(formatter)
-        handler.setLevel(self.log.level)
-        self.logger.addHandler(handler)
-
-        # Add a handler to write messages to a file
-        if self.log.file:
-            file_handler = logging.FileHandler(self.log.file)
-            file_handler.setFormatter(formatter)
-            file_handler.setLevel(self.log.level)
-            self.logger.addHandler(file_handler)
-
-        # Add a handler to write messages to stdout
-        if self.log.stdout:
-            stdout_handler = logging.StreamHandler()
-            stdout_handler.setFormatter(formatter)
-            stdout_handler.setLevel(self.log.level)
-            self.logger.addHandler(stdout_handler)
-    
+        """Create a logger that only enqueues records, also feeding the message queue of the displays."""
+        self.logger, self.log_listener = enqueue_logger(self.log, messages=self.messages, notify=self.notify)
         self.logger.debug(f"Logger ready.")
 
+    def close(self) -> None:
+        """Close the run journal, then flush and stop the log listener."""
+        if self.journal != None:
+            self.journal.close()
+        self.log_listener.stop()
+
+    def subscribe(self, listener) -> None:
+        """
+        Register a callable to be notified of state changes.
+
+        The listener is called without arguments, possibly from another
+        thread, and should only schedule a refresh. Events themselves are
+        collected from self.events, which is only filled once there is a
+        listener.
+        """
+        self.listeners.append(listener)
+
+    def notify(self) -> None:
+        for listener in self.listeners:
+            listener()
+
+    def publish(self, event:Event) -> None:
+        """Publish a state-change event to the listeners."""
+        if self.listeners:
+            self.events.put(event)
+            self.notify()
+
     async def load(self) -> None:
         self.logger.info(f"Loading workflow: {self.workflow_yaml}")
         self.workflow = Workflow(self.workflow_yaml)
         self.logger.info(f"Workflow loaded: {self.workflow.name}")
         self.title = self.workflow.name
 
-    def run_workflow(self, log_name: str):
-        """Run workflow and add tasks to the queue."""
-        logger = logging.getLogger(name=log_name)
-        self.logger.info("Running workflow.")
-        for job,job_data in self.jobs.items():
-            self.validate_job(job, logger)
-            self.tree[job] = OrderedDict()
-            # steps = job_data["steps"] if "steps" in job_data and job_data["steps"] != None else {}
-            # for step,step_data in job_data["steps"].items():
-            #     logger.info(f"Running step: {step}")
-            #     if step in self.tree[job]:
-            #         msg = "Step name {step} is not unique to job {job}."
-            #         logger.error(msg)
-            #         raise Exception(msg)
-            #     for i,task in enumerate(step_data):
-            #         identifier = f"{job}.{step}.{task}.{i}"
-            #         if task in self.tree[job][step]:
-            #             msg = "Task name {task} is not unique to step {step}."
-            #             logger.error(msg)
-            #             raise Exception(msg)
-            #         logger.info(f"Dispatching task: {identifier}")
-            #         t = asyncio.create_task(self.demo(identifier))
-            #         self.tasks[identifier] = t
-
-    def validate_job(self, job, logger):
-        logger.info(f"Validating job: {job}")
+    def build_tree(self) -> None:
+        """
+        Build the job/step dependency DAG in self.tree.
+
+        Raises an Exception if a dependency is unknown or the graph has a cycle.
+        """
+        for job in self.jobs:
+            self.validate_job(job)
+            self.tree[job] = Node(job, job, order=len(self.tree))
+            for step,step_data in self.get_steps(job).items():
+                identifier = f"{job}.{step}"
+                data = step_data if step_data != None else {}
+                self.tree[identifier] = Node(identifier, job, step, data, order=len(self.tree))
+                self.validate_step(self.tree[identifier])
+
+        for job in self.jobs:
+            job_deps = [self.resolve_dependency(None, d) for d in self.get_dependencies(self.jobs[job])]
+            for dependency in job_deps:
+                self.add_edge(dependency, job)
+            for step,step_data in self.get_steps(job).items():
+                identifier = f"{job}.{step}"
+                # A job completes once all of its steps have completed
+                self.add_edge(identifier, job)
+                for dependency in job_deps:
+                    self.add_edge(dependency, identifier)
+                for dependency in self.get_dependencies(step_data):
+                    self.add_edge(self.resolve_dependency(job, dependency), identifier)
+
+        # Kahn's algorithm, a cycle leaves nodes that never become ready
+        order = self.order()
+        if len(order) != len(self.tree):
+            done  = set(order)
+            cycle = [identifier for identifier in self.tree if identifier not in done]
+            msg = f"Workflow dependencies contain a cycle: {', '.join(cycle)}"
+            self.logger.error(msg)
+            raise Exception(msg)
+
+        # Priority is the longest remaining (critical) path through the DAG
+        for identifier in reversed(order):
+            node = self.tree[identifier]
+            node.priority = node.weight + max([self.tree[d].priority for d in node.dependents], default=0)
+
+    def add_edge(self, dependency:str, dependent:str) -> None:
+        self.tree[dependent].dependencies.add(dependency)
+        self.tree[dependency].dependents.add(dependent)
+
+    def get_dependencies(self, data:dict) -> list[str]:
+        dependencies = data.get("dependency") if type(data) == dict else None
+        if dependencies == None:
+            return []
+        return [str(dependencies)] if type(dependencies) != list else [str(d) for d in dependencies]
+
+    def resolve_dependency(self, job:str, dependency:str) -> str:
+        """Resolve a dependency name to a node: a sibling step of job, a job, or 'job.step'."""
+        if job != None and f"{job}.{dependency}" in self.tree:
+            return f"{job}.{dependency}"
+        elif dependency in self.tree:
+            return dependency
+        msg = f"Unknown dependency '{dependency}'" + (f" in job '{job}'." if job else ".")
+        self.logger.error(msg)
+        raise Exception(msg)
+
+    def estimate_tasks(self, data:dict) -> int:
+        """Return the number of tasks a step expands into, from its variable list lengths, without expanding them."""
+        variables = data["variables"] if "variables" in data and data["variables"] != None else {}
+        total = 1
+        for v in variables.values():
+            if type(v) != dict:
+                total *= len(self.variable_values(v))
+        return total
+
+    def plan(self, history:str=None) -> str:
+        """
+        Return a report of the tasks each step expands into and the estimated run time.
+
+        Durations are the mean task durations of each step in the run
+        journals of this workflow in history. The estimate is the longer of
+        the critical path and the total work spread over the worker slots,
+        ignoring steps that have never run.
+        """
+        durations = Journal.durations(history, os.path.abspath(self.path)) if history != None else {}
+        lines = [f"{'step':30} {'tasks':>8} {'mean':>9} {'estimate':>9}"]
+        finish, work, unknown = {}, 0, 0
+        for identifier,node in self.tree.items():
+            if node.step == None:
+                continue
+            mean = durations.get(identifier)
+            if mean == None:
+                unknown += 1
+                lines.append(f"{identifier:30} {node.weight:>8} {'?':>9} {'?':>9}")
+                continue
+            work += node.weight * mean
+            elapsed = math.ceil(node.weight / self.concurrency) * mean
+            lines.append(f"{identifier:30} {node.weight:>8} {mean:>8.2f}s {elapsed:>8.2f}s")
+
+        # Longest path through the DAG, nodes start once their dependencies finish
+        for identifier in self.order():
+            node = self.tree[identifier]
+            mean = durations.get(identifier, 0) if node.step != None else 0
+            start = max([finish[d] for d in node.dependencies], default=0)
+            finish[identifier] = start + math.ceil(node.weight / self.concurrency) * mean
+        estimate = max(max(finish.values(), default=0), work / self.concurrency)
+
+        steps = [node for node in self.tree.values() if node.step != None]
+        lines.insert(0, f"Workflow: {self.name} ({len(self.jobs)} jobs, {len(steps)} steps, {sum(n.weight for n in steps)} tasks, concurrency {self.concurrency})")
+        lines.append(f"Estimated run time: {estimate:.2f}s" + (f" ({unknown} steps without history)" if unknown else ""))
+        return "\n".join(lines)
+
+    def order(self) -> list[str]:
+        """Return the nodes of the DAG in topological order, or a partial order if it has a cycle."""
+        waiting = {identifier:len(node.dependencies) for identifier,node in self.tree.items()}
+        ready   = [identifier for identifier,count in waiting.items() if count == 0]
+        order   = []
+        while ready:
+            identifier = ready.pop()
+            order.append(identifier)
+            for dependent in self.tree[identifier].dependents:
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    ready.append(dependent)
+        return order
+
+    async def run_workflow(self) -> None:
+        """
+        Run workflow, dispatching expanded tasks to a bounded pool of asyncio tasks.
+
+        Nodes of the DAG start as soon as their dependencies complete, and ready
+        nodes are dispatched in order of their longest remaining critical path.
+        Failed tasks are retried after an exponential backoff, which they wait
+        out without holding a worker slot.
+        """
+        import asyncio
+        self.logger.info(f"Running workflow: {self.name} (concurrency: {self.concurrency})")
+        if self.journal != None:
+            self.logger.info(f"Run id: {self.journal.run_id} (resume with --resume {self.journal.run_id})")
+        start   = time.monotonic()
+        if self.coordinator != None:
+            await self.coordinator.start()
+        slots   = asyncio.Semaphore(self.concurrency)
+        wakeup  = asyncio.Event()
+        ready   = []
+        waiting = {identifier:len(node.dependencies) for identifier,node in self.tree.items()}
+        # Failed tasks waiting out their backoff, and those due for another attempt
+        backoff = {}
+        retries = collections.deque()
+        loop    = asyncio.get_running_loop()
+        nodes_completed = 0
+        stopping        = False
+
+        def node_ready(node:Node) -> None:
+            # Failures don't stop the other branches, but nothing downstream of them runs
+            failed = {self.tree[d].result for d in node.dependencies} - {None, TaskResult.PASS}
+            if node.step == None:
+                node.result = TaskResult.FAIL if TaskResult.FAIL in failed else TaskResult.CANCELLED if failed else None
+                node_complete(node)
+                return
+            if failed:
+                self.logger.warning(f"Skipping step: {node}, a dependency failed or was skipped")
+                node.result = TaskResult.CANCELLED
+                self.skipped.append(node.identifier)
+                node_complete(node)
+                return
+            self.logger.info(f"Running step: {node}")
+            try:
+                node.specs = iter(self.dynamic_tasks(node.data))
+            except Exception as e:
+                step_failed(node, e)
+                node_complete(node)
+                return
+            node.status = TaskStatus.RUNNING
+            self.publish(Event(EventType.UPDATE, node.identifier, node.status))
+            heapq.heappush(ready, (-node.priority, node.order, node.identifier))
+
+        def node_complete(node:Node) -> None:
+            nonlocal nodes_completed
+            node.status = TaskStatus.COMPLETE
+            nodes_completed += 1
+            self.logger.info(f"Completed {'step' if node.step else 'job'}: {node}")
+            self.publish(Event(EventType.UPDATE, node.identifier, node.status, node.result))
+            for dependent in node.dependents:
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    node_ready(self.tree[dependent])
+            wakeup.set()
+
+        def failed(name:str) -> None:
+            nonlocal stopping
+            if self.policy == FailurePolicy.FAIL_FAST and not stopping:
+                self.logger.error(f"Stopping the workflow after the failure of {name} ({self.policy})")
+                stopping = True
+
+        def step_failed(node:Node, error:Exception) -> None:
+            # The step data can't be expanded into tasks, fail the step rather than the whole run
+            self.logger.error(f"Failed to expand the tasks of step {node}: {error}")
+            self.errors[node.identifier] = str(error)
+            node.result = TaskResult.FAIL
+            failed(f"step {node}")
+
+        def task_complete(task:Task, node:Node) -> None:
+            self.record_journal(task)
+            # Only failures are kept, so memory doesn't grow with the number of tasks
+            self.tasks.pop(task.name, None)
+            if task.result != TaskResult.PASS:
+                self.failed[task.name] = task
+            # Passing tasks leave the tree, failures stay visible
+            event_type = EventType.REMOVE if task.result == TaskResult.PASS else EventType.UPDATE
+            self.publish(Event(event_type, task.name, task.status, task.result, leaf=True))
+            self.completed += 1
+            self.finished[node.job] += 1
+            self.results[task.result] += 1
+            if task.result != TaskResult.PASS:
+                node.result = TaskResult.FAIL
+            node.running -= 1
+            if task.result == TaskResult.FAIL:
+                failed(f"task {task}")
+            if node.expanded and node.running == 0:
+                node_complete(node)
+
+        def task_retry(task:Task, node:Node) -> None:
+            delay = node.backoff * 2 ** (task.attempts - 1)
+            self.logger.warning(f"Retrying task {task} in {delay:.1f}s (attempt {task.attempts + 1} of {node.retries + 1}): {task.error or f'return code {task.return_code}'}")
+            task.status = TaskStatus.PENDING
+            self.publish(Event(EventType.UPDATE, task.name, task.status, task.result, leaf=True))
+
+            def due() -> None:
+                del backoff[task.name]
+                retries.append((task, node))
+                wakeup.set()
+
+            backoff[task.name] = (task, node, loop.call_later(delay, due))
+
+        async def dispatch(task:Task, node:Node) -> None:
+            retry = False
+            try:
+                if task.attempts == 0:
+                    self.publish(Event(EventType.ADD, task.name, TaskStatus.RUNNING, parent=node.identifier, leaf=True))
+                else:
+                    self.publish(Event(EventType.UPDATE, task.name, TaskStatus.RUNNING, leaf=True))
+                self.running[task.name] = task
+                if task.attempts > 0 or not (self.restore_resumed(task) or await self.restore_cached(task)):
+                    self.record_journal(task)
+                    await task.run()
+                    retry = task.result == TaskResult.FAIL and task.attempts <= node.retries and not stopping
+                    if not retry:
+                        await self.store_cached(task)
+                self.logger.info(f"Completed task: {task.summary()}")
+            except asyncio.CancelledError:
+                task.status = TaskStatus.COMPLETE
+                task.result = TaskResult.CANCELLED
+                task.error  = "Cancelled after a failure"
+                raise
+            finally:
+                self.running.pop(task.name, None)
+                self.memory_in_use -= task.limits.memory or 0
+                slots.release()
+                if retry:
+                    task_retry(task, node)
+                else:
+                    task_complete(task, node)
+                wakeup.set()
+
+        for identifier,node in self.tree.items():
+            parent = node.job if node.step != None else None
+            self.publish(Event(EventType.ADD, identifier, node.status, parent=parent))
+
+        # Roots only, completing one can make others ready while iterating
+        for identifier in [identifier for identifier,count in waiting.items() if count == 0]:
+            node_ready(self.tree[identifier])
+
+        while nodes_completed < len(self.tree) and not stopping:
+            # Wait for a free worker slot, then for a retry or a node with tasks left to dispatch
+            await slots.acquire()
+            while not ready and not retries and nodes_completed < len(self.tree) and not stopping:
+                wakeup.clear()
+                await wakeup.wait()
+            if stopping or (not ready and not retries):
+                slots.release()
+                break
+
+            # Retries are already admitted to the tree, they go before new tasks
+            if retries and self.admit(retries[0][1]):
+                task, node = retries.popleft()
+                self.logger.info(f"Dispatching task: {task} (attempt {task.attempts + 1} of {node.retries + 1})")
+                self.memory_in_use += task.limits.memory or 0
+                task.future = asyncio.create_task(dispatch(task, node))
+                continue
+
+            # Admission control, the highest priority node whose declared memory fits
+            entry = next((e for e in sorted(ready) if self.admit(self.tree[e[2]])), None)
+            if entry == None:
+                slots.release()
+                wakeup.clear()
+                await wakeup.wait()
+                continue
+
+            node = self.tree[entry[2]]
+            try:
+                task_data = next(node.specs, None)
+            except Exception as e:
+                step_failed(node, e)
+                task_data = None
+            if task_data == None:
+                slots.release()
+                ready.remove(entry)
+                heapq.heapify(ready)
+                node.expanded = True
+                if node.running == 0:
+                    node_complete(node)
+                continue
+
+            identifier = f"{node}.{len(node.tasks)}"
+            task = Task(
+                name=identifier,
+                data=task_data,
+                safe=self.safe,
+                executor=self.get_executor(task_data, node.limits) if self.coordinator == None else None,
+                log=self.log,
+                logger=self.logger,
+                limits=node.limits,
+                remote=self.coordinator,
+            )
+            self.logger.info(f"Dispatching task: {identifier}")
+            # Reserve the declared memory now, before the next admission check
+            self.memory_in_use += task.limits.memory or 0
+            node.running += 1
+            node.tasks.append(identifier)
+            self.tasks[identifier] = task
+            task.future = asyncio.create_task(dispatch(task, node))
+
+        if stopping:
+            # Failures waiting for a retry are final, everything still running is cancelled at once
+            for task,node,handle in list(backoff.values()):
+                handle.cancel()
+                task.status = TaskStatus.COMPLETE
+                task_complete(task, node)
+            for task,node in retries:
+                task.status = TaskStatus.COMPLETE
+                task_complete(task, node)
+            backoff.clear()
+            retries.clear()
+            outstanding = [task.future for task in self.tasks.values() if task.future != None and not task.future.done()]
+            for future in outstanding:
+                future.cancel()
+            await asyncio.gather(*outstanding, return_exceptions=True)
+
+        for executor in self.executors.values():
+            executor.shutdown()
+        self.executors.clear()
+        if self.coordinator != None:
+            await self.coordinator.close()
+        if self.journal != None:
+            await asyncio.to_thread(self.journal.flush)
+
+        elapsed = time.monotonic() - start
+        self.throughput = self.completed / elapsed if elapsed > 0 else 0
+        self.logger.info(f"Workflow {'stopped' if stopping else 'complete'}: {self.completed} tasks in {elapsed:.2f}s ({self.throughput:.2f} tasks/s)")
+
+    def validate(self) -> None:
+        """Check the top level schema of the workflow, jobs and steps are checked while building the tree."""
+        if type(self.data) != dict:
+            msg = f"Workflow {self.path} must be a mapping, not {type(self.data).__name__}."
+            self.logger.error(msg)
+            raise Exception(msg)
+        self.validate_keys("workflow", self.path, self.data, self.workflow_keys)
+        if self.data.get("jobs") != None and type(self.data["jobs"]) != dict:
+            msg = f"The jobs of workflow {self.path} must be a mapping of job names to jobs."
+            self.logger.error(msg)
+            raise Exception(msg)
+
+    def validate_keys(self, kind:str, name:str, data:dict, known:set) -> None:
+        unknown = [str(key) for key in data if key not in known]
+        if unknown:
+            msg = f"Unknown key(s) {', '.join(unknown)} in {kind} '{name}', choices: {', '.join(sorted(str(k) for k in known if k != True))}"
+            self.logger.error(msg)
+            raise Exception(msg)
+
+    def validate_step(self, node:Node) -> None:
+        data = node.data
+        if type(data) != dict:
+            msg = f"Step '{node}' must be a mapping, not {type(data).__name__}."
+            self.logger.error(msg)
+            raise Exception(msg)
+        self.validate_keys("step", node, data, self.step_keys)
+        variables = data.get("variables")
+        if variables != None and type(variables) != dict:
+            msg = f"The variables of step '{node}' must be a mapping of names to values."
+            self.logger.error(msg)
+            raise Exception(msg)
+        # Evaluate the variables now, an expression that fails would otherwise only fail at run time
+        try:
+            node.weight = self.estimate_tasks(data)
+        except Exception as e:
+            msg = f"Invalid variables in step '{node}': {e}"
+            self.logger.error(msg)
+            raise Exception(msg)
+        # Catch typo'd placeholders now rather than when the step starts, mapping values aren't expanded
+        template = Template({k:v for k,v in data.items() if k != "variables"})
+        undefined = sorted(template.variables - {k for k,v in (variables or {}).items() if type(v) != dict})
+        if undefined:
+            msg = f"Undefined format variable(s) {', '.join(undefined)} in step '{node}'."
+            if set(undefined) & set(variables or {}):
+                msg += " Variables with a mapping value can't be used in placeholders."
+            self.logger.error(msg)
+            raise Exception(msg)
+        try:
+            node.limits = Limits.from_step(data)
+        except Exception as e:
+            msg = f"Invalid limits in step '{node}': {e}"
+            self.logger.error(msg)
+            raise Exception(msg)
+        try:
+            node.retries = int(data.get("retries", 0))
+            node.backoff = float(data.get("backoff", 1))
+            if node.retries < 0 or node.backoff < 0 or (node.limits.timeout != None and node.limits.timeout <= 0):
+                raise Exception("retries and backoff can't be negative, and timeout must be positive")
+        except Exception as e:
+            msg = f"Invalid retry policy in step '{node}': {e}"
+            self.logger.error(msg)
+            raise Exception(msg)
+        if "executor" not in data:
+            return
+        kind = ExecutorType.argparse(str(data["executor"]))
+        if type(kind) != ExecutorType:
+            msg = f"Unknown executor '{data['executor']}' in step '{node}', choices: {list(ExecutorType)}"
+            self.logger.error(msg)
+            raise Exception(msg)
+        is_function = "function" in data or isinstance(data.get("run"), dict)
+        if node.limits and kind not in (ExecutorType.PROCESS, ExecutorType.ISOLATED) and is_function:
+            msg = f"Step '{node}' declares limits or a timeout, which function steps can only enforce in a process of their own, with the {ExecutorType.PROCESS} or {ExecutorType.ISOLATED} executor."
+            self.logger.error(msg)
+            raise Exception(msg)
+
+    def get_executor(self, data:dict, limits:Limits=None) -> Executor:
+        """Return the executor backend of a task, creating it on first use."""
+        kind = executor_kind(data, limits, self.executor)
+        if kind not in self.executors:
+            self.logger.info(f"Starting {kind} executor.")
+            self.executors[kind] = create_executor(kind, max_workers=self.concurrency)
+        return self.executors[kind]
+
+    def open_journal(self, directory:str, resume:str) -> None:
+        """Open the run journal, loading the tasks completed by the run being resumed."""
+        if directory == None:
+            if resume != None:
+                msg = f"Cannot resume run '{resume}' with the run journal disabled."
+                self.logger.error(msg)
+                raise Exception(msg)
+            return
+        if resume != None:
+            try:
+                records = Journal.load(directory, resume)
+            except Exception as e:
+                self.logger.error(str(e))
+                raise
+            self.resumed = {
+                task:record for task,record in records.items()
+                if record["status"] == TaskStatus.COMPLETE.name and record.get("result") == TaskResult.PASS.name
+            }
+            self.logger.info(f"Resuming run {resume}: {len(self.resumed)} of {len(records)} tasks already complete.")
+        self.journal = Journal(directory, run_id=resume, workflow=os.path.abspath(self.path))
+
+    @staticmethod
+    def fingerprint(task:Task) -> str:
+        """Return a short hash of the task spec, so a resumed run doesn't skip a task whose spec changed."""
+        spec = json.dumps(task.data, sort_keys=True, default=str)
+        return hashlib.sha256(spec.encode()).hexdigest()[0:16]
+
+    def restore_resumed(self, task:Task) -> bool:
+        """Skip a task completed by the run being resumed, returns True if skipped."""
+        record = self.resumed.get(task.name)
+        if record == None or record.get("spec") != self.fingerprint(task):
+            return False
+        task.restore(record)
+        self.logger.info(f"Skipped task completed by run {self.journal.run_id}: {task}")
+        return True
+
+    def record_journal(self, task:Task) -> None:
+        """Append the current status of a task to the run journal."""
+        if self.journal == None:
+            return
+        if task.status == TaskStatus.COMPLETE:
+            self.journal.record(task.name, task.status.name, result=task.result.name, return_code=task.return_code, spec=self.fingerprint(task))
+        else:
+            self.journal.record(task.name, TaskStatus.RUNNING.name)
+
+    async def restore_cached(self, task:Task) -> bool:
+        """Restore the result of a task from the cache, returns True on a hit."""
+        import asyncio
+        if self.cache == None or not task.cacheable():
+            return False
+        try:
+            task.cache_key = await asyncio.to_thread(self.cache.key, task.data, task.inputs())
+            record = await asyncio.to_thread(self.cache.get, task.cache_key)
+        except OSError as e:
+            self.logger.warning(f"Cache lookup failed for task {task}: {e}")
+            return False
+        if record == None:
+            return False
+        task.restore(record)
+        self.logger.info(f"Restored task from cache: {task} ({task.cache_key[0:12]})")
+        return True
+
+    async def store_cached(self, task:Task) -> None:
+        """Store the result of a passing task in the cache."""
+        import asyncio
+        if task.cache_key == None or task.result != TaskResult.PASS:
+            return
+        try:
+            await asyncio.to_thread(self.cache.put, task.cache_key, task.record(), task.outputs())
+        except OSError as e:
+            self.logger.warning(f"Could not cache result of task {task}: {e}")
+
+    def admit(self, node:Node) -> bool:
+        """Return True if a task of node fits within --max-memory, given the running tasks."""
+        memory = node.limits.memory or 0
+        if self.max_memory == None or memory == 0 or self.memory_in_use == 0:
+            return True
+        return self.memory_in_use + memory <= self.max_memory
+
+    def validate_job(self, job):
+        self.logger.info(f"Validating job: {job}")
         if job in self.tree:
-            msg = "Job name '{job}' is not unique."
-            logger.error(msg)
+            msg = f"Job name '{job}' is not unique."
+            self.logger.error(msg)
+            raise Exception(msg)
+        data = self.jobs[job]
+        if data == None:
+            return
+        if type(data) != dict:
+            msg = f"Job '{job}' must be a mapping, not {type(data).__name__}."
+            self.logger.error(msg)
+            raise Exception(msg)
+        self.validate_keys("job", job, data, self.job_keys)
+        if data.get("steps") != None and type(data["steps"]) != dict:
+            msg = f"The steps of job '{job}' must be a mapping of step names to steps."
+            self.logger.error(msg)
             raise Exception(msg)
 
     def get_steps(self, job) -> dict:
         d = self.jobs[job]
-        return d["steps"] if "steps" in d and d["steps"] != None else {}
+        return d["steps"] if d != None and "steps" in d and d["steps"] != None else {}
 
     def get_tasks(self, job, step) -> dict:
         return self.jobs[job]["steps"][step]
 
-    async def demo(self, identifier):
-        if "slow" in identifier:
-           time.sleep(5)
-        return identifier
+    def variable_values(self, values) -> list:
+        """
+        Return the list of values of a variable, evaluating non-list values as expressions.
+
+        Values that don't parse as Python, or only use unknown names without
+        calling anything, like `linux` or `my-host`, are literal values. Any
+        other expression must evaluate, so a typo fails validation instead
+        of silently becoming a single literal task.
+        """
+        import ast
+        if type(values) == list:
+            return values
+        try:
+            tree = ast.parse(str(values).strip(), mode="eval")
+        except SyntaxError:
+            return [values]
+        names = {n.id for n in ast.walk(tree) if isinstance(n, ast.Name)}
+        calls = any(isinstance(n, ast.Call) for n in ast.walk(tree))
+        if names and not calls and not names & (set(Expression.builtins) | set(Expression.modules)):
+            return [values]
+        values = Expression.get(str(values), self.safe).evaluate()
+        return values if type(values) == list else [values]
+
+    def dynamic_tasks(self, data:dict) -> Iterator[dict]:
+        """
+        Lazily expand step data into one rendered task spec per combination of its variables.
+
+        The step data is compiled into a Template once, and each combination
+        only re-renders the leaves that contain placeholders. Combinations are
+        generated one at a time with itertools.product, so nothing is
+        materialized before the scheduler asks for the next task.
+        """
+        variables = data["variables"] if "variables" in data and data["variables"] != None else {}
+        template  = Template({k:v for k,v in data.items() if k != "variables"})
+
+        names  = [k for k,v in variables.items() if type(v) != dict]
+
+        # Fail early on placeholders that no variable will ever fill
+        for var in sorted(template.variables):
+            if var not in names:
+                raise Exception(f"Undefined format variable `{var}` in step data: {data}")
+
+        values = [self.variable_values(variables[k]) for k in names]
+
+        def expand():
+            for combination in itertools.product(*values):
+                # Keep the bound values of this combination with the rendered spec
+                bound = freeze(dict(zip(names, combination)))
+                yield FrozenDict(template.render(bound), variables=bound)
+
+        return expand()
+
+class EnqueueHandler(logging.Handler):
+    """A logging.Handler that only puts records on a queue, for a LogListener to format and write."""
+
+    def __init__(self, records:queue.SimpleQueue, level=logging.NOTSET, listener:"LogListener"=None):
+        logging.Handler.__init__(self, level=level)
+        self.records  = records
+        self.listener = listener
+
+    def emit(self, record):
+        self.records.put_nowait(record)
+
+def enqueue_logger(log:Log, messages:queue.Queue=None, notify=None) -> tuple:
+    """
+    Return the logger named log.name set up to only enqueue records, and its started LogListener.
+
+    A single LogListener thread formats each record once and writes it to
+    the log file, stderr and the message queue, so logging never blocks
+    the event loop on I/O.
+    """
+    logger = logging.getLogger(name=log.name)
+    logger.setLevel(log.level)
+    logger.propagate = False
+    # The logger is shared by name, stop the listener it had so its thread and file don't leak
+    for handler in list(logger.handlers):
+        if isinstance(handler, EnqueueHandler):
+            logger.removeHandler(handler)
+            if handler.listener != None:
+                handler.listener.stop()
+
+    records = queue.SimpleQueue()
+    listener = LogListener(
+        records,
+        formatter=logging.Formatter(log.formatter, log.datefmt),
+        file=log.file,
+        stream=sys.stderr if log.stdout else None,
+        messages=messages,
+        notify=notify,
+    )
+    logger.addHandler(EnqueueHandler(records, level=log.level, listener=listener))
+    listener.start()
+    return (logger, listener)
+
+class LogListener(threading.Thread):
+    def __init__(
+        self,
+        records:queue.SimpleQueue,
+        formatter:logging.Formatter,
+        file:str=None,
+        stream=None,
+        messages:queue.Queue=None,
+        notify=None,
+        batch:int=1000,
+        interval:float=0.1,
+    ):
+        """
+        Format queued log records once and fan them out to the sinks.
+
+        Records are handled in batches of up to batch records, waiting at most
+        interval seconds for a batch to fill. Each batch is a single write and
+        flush per sink and a single notify.
+        """
+        super().__init__(name="log-listener", daemon=True)
+        self.records   = records
+        self.formatter = formatter
+        self.file      = open(file, "w", buffering=1<<16) if file else None
+        self.stream    = stream
+        self.messages  = messages
+        self.notify    = notify
+        self.batch     = batch
+        self.interval  = interval
+        self.stopped   = False
+        atexit.register(self.stop)
+
+    def run(self) -> None:
+        running = True
+        while running:
+            records = [self.records.get()]
+            deadline = time.monotonic() + self.interval
+            while len(records) < self.batch and records[-1] != None:
+                try:
+                    records.append(self.records.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if None in records:
+                running = False
+                records = records[0:records.index(None)]
+            self.handle(records)
+
+    def handle(self, records:list) -> None:
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.formatter.format(record).rstrip("\n"))
+            except Exception:
+                lines.append(f"Could not format log record: {record}")
+        if not lines:
+            return
+        text = "\n".join(lines) + "\n"
+        for sink in [self.file, self.stream]:
+            if sink != None:
+                sink.write(text)
+                sink.flush()
+        if self.messages != None:
+            for line in lines:
+                self.messages.put(line)
+            if self.notify != None:
+                self.notify()
+
+    def stop(self) -> None:
+        """Handle the queued records and close the log file."""
+        if self.stopped:
+            return
+        self.stopped = True
+        if self.is_alive():
+            self.records.put(None)
+            self.join()
+        if self.file != None:
+            self.file.close()
 
 class QueuingHandler(logging.Handler):
     """
@@ -172,11 +1656,14 @@ class QueuingHandler(logging.Handler):
     destinations will be corrupted.
     """
 
-    def __init__(self, *args, message_queue, **kwargs):
+    def __init__(self, *args, message_queue, notify=None, **kwargs):
         """Initialize by copying the queue and sending everything else to superclass."""
         logging.Handler.__init__(self, *args, **kwargs)
         self.message_queue = message_queue
+        self.notify = notify
 
     def emit(self, record):
         """Add the formatted log message (sans newlines) to the queue."""
-        self.message_queue.put(self.format(record).rstrip('\n'))
\ No newline at end of file
+        self.message_queue.put(self.format(record).rstrip('\n'))
+        if self.notify != None:
+            self.notify()
\ No newline at end of file
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+
+from distributed import Coordinator, Worker
+from workflow import Log, Task, TaskResult
+
+def task_log(name:str) -> Log:
+    return Log(name=name, file=None, stdout=False, task_dir=None)
+
+def start_worker(address:str, name:str, slots:int=1, heartbeat:float=0.1) -> tuple:
+    # Workers of one process share a hostname:pid identifier, the coordinator keys them by it
+    worker = Worker(address, slots=slots, heartbeat=heartbeat, log=task_log(name))
+    worker.identifier = name
+    return (worker, asyncio.create_task(worker.run()))
+
+async def run_tasks(coordinator:Coordinator, commands:list) -> list:
+    specs = [command if type(command) == dict else {"run": command} for command in commands]
+    tasks = [Task(f"task.{i}", spec, log=coordinator.log, logger=coordinator.logger, remote=coordinator) for i,spec in enumerate(specs)]
+    await asyncio.gather(*[task.run() for task in tasks])
+    return tasks
+
+async def wait_until(condition, timeout:float=10) -> None:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        assert loop.time() < deadline, "timed out waiting for the coordinator"
+        await asyncio.sleep(0.01)
+
+async def close(coordinator:Coordinator, *workers) -> None:
+    await coordinator.close()
+    for worker,running in workers:
+        if not running.done():
+            await asyncio.wait_for(running, timeout=5)
+        worker.close()
+
+def coordinator(tmp_path, **kwargs) -> Coordinator:
+    return Coordinator(f"unix:{tmp_path}/coordinator.sock", logging.getLogger("test.coordinator"), log=task_log("test.coordinator"), **kwargs)
+
+def test_results(tmp_path):
+    async def main():
+        server = coordinator(tmp_path)
+        await server.start()
+        workers = [start_worker(server.address, "w1", slots=2), start_worker(server.address, "w2", slots=2)]
+        await wait_until(lambda: len(server.workers) == 2)
+        tasks = await run_tasks(server, [f"sh -c 'sleep 0.1; echo {i}'" for i in range(8)] + ["false"])
+        await close(server, *workers)
+        return tasks, workers
+
+    tasks, workers = asyncio.run(main())
+    assert [task.result for task in tasks] == [TaskResult.PASS] * 8 + [TaskResult.FAIL]
+    assert [task.stdout for task in tasks[:8]] == [str(i) for i in range(8)]
+    assert all(worker.completed > 0 for worker,_ in workers)
+
+def test_worker_error_fails_the_task(tmp_path):
+    async def main():
+        server = coordinator(tmp_path)
+        await server.start()
+        worker = start_worker(server.address, "w1")
+        await wait_until(lambda: "w1" in server.workers)
+        # The worker can't build the limits of this spec, before the task even runs
+        tasks = await asyncio.wait_for(run_tasks(server, [{"run": "true", "limits": {"unknown": 1}}, "true"]), timeout=10)
+        await close(server, worker)
+        return tasks
+
+    tasks = asyncio.run(main())
+    assert [task.result for task in tasks] == [TaskResult.FAIL, TaskResult.PASS]
+    assert "Unknown limits" in tasks[0].error
+
+def test_requeue_after_worker_dies(tmp_path):
+    async def main():
+        server = coordinator(tmp_path)
+        await server.start()
+        first = start_worker(server.address, "w1")
+        await wait_until(lambda: "w1" in server.workers)
+        running = asyncio.create_task(run_tasks(server, ["sh -c 'sleep 0.3; echo done'"]))
+        await wait_until(lambda: "task.0" in server.workers["w1"].started)
+        second = start_worker(server.address, "w2")
+        await wait_until(lambda: "w2" in server.workers)
+        # Drop the connection without a result, as a killed worker would
+        first[0].writer.transport.abort()
+        first[1].cancel()
+        tasks = await running
+        await close(server, second)
+        first[0].close()
+        return tasks, first[0], second[0]
+
+    tasks, first, second = asyncio.run(main())
+    assert tasks[0].result == TaskResult.PASS
+    assert tasks[0].stdout == "done"
+    assert (first.completed, second.completed) == (0, 1)
+
+def test_requeue_after_heartbeat_timeout(tmp_path):
+    async def main():
+        server = coordinator(tmp_path, heartbeat_timeout=0.5)
+        await server.start()
+        # Only beats once, the coordinator gives up on it while its task runs
+        quiet = start_worker(server.address, "w1", heartbeat=60)
+        await wait_until(lambda: "w1" in server.workers)
+        running = asyncio.create_task(run_tasks(server, ["sleep 1"]))
+        await wait_until(lambda: "task.0" in server.workers["w1"].started)
+        second = start_worker(server.address, "w2")
+        tasks = await running
+        await close(server, quiet, second)
+        return tasks, second[0]
+
+    tasks, second = asyncio.run(main())
+    assert tasks[0].result == TaskResult.PASS
+    assert second.completed == 1
+
+def test_work_stealing(tmp_path):
+    async def main():
+        # A large prefetch hands every task to the first worker to connect
+        server = coordinator(tmp_path, prefetch=10)
+        await server.start()
+        first = start_worker(server.address, "w1")
+        await wait_until(lambda: "w1" in server.workers)
+        running = asyncio.create_task(run_tasks(server, ["sleep 0.2"] * 6))
+        await wait_until(lambda: len(server.workers["w1"].assigned) == 6)
+        second = start_worker(server.address, "w2")
+        tasks = await running
+        await close(server, first, second)
+        return tasks, first[0], second[0]
+
+    tasks, first, second = asyncio.run(main())
+    assert all(task.result == TaskResult.PASS for task in tasks)
+    assert second.completed > 0
+    assert first.completed + second.completed == 6
@@ -0,0 +1,24 @@
+import pytest
+
+from workflow import Expression
+
+def test_evaluate():
+    assert Expression.get("max(x * 2 for x in range(3))").evaluate() == 4
+    assert Expression.get("'a b'.split()").evaluate() == ["a", "b"]
+    assert Expression.get("math.floor(2.5)").evaluate() == 2
+
+@pytest.mark.parametrize("source", [
+    "open('/etc/passwd')",
+    "().__class__.__base__.__subclasses__()",
+    "'{0.__class__}'.format(1)",
+    # Generator frame -> Expression.evaluate -> the globals of the workflow module
+    "[gl.append((y.gi_frame.f_back.f_back.f_back.f_globals['os'].getcwd() for y in gl)) or list(gl[0]) for gl in [[]]]",
+    "(lambda: 0).__code__",
+    "[y.gi_code for y in [(x for x in [])]]",
+])
+def test_safe_mode_rejects_escapes(source):
+    with pytest.raises(Exception, match="not allowed in safe mode"):
+        Expression.get(source).evaluate()
+
+def test_unsafe_mode():
+    assert Expression.get("__import__('os').sep", safe=False).evaluate() == "/"
@@ -0,0 +1,146 @@
+import asyncio
+import time
+
+import pytest
+import yaml
+
+from workflow import FailurePolicy, Log, TaskResult, Workflow
+
+def task_log(name:str) -> Log:
+    return Log(name=name, file=None, stdout=False, task_dir=None)
+
+def workflow(tmp_path, jobs:dict, **kwargs) -> Workflow:
+    path = tmp_path / "workflow.yml"
+    path.write_text(yaml.safe_dump({"name": "test", "jobs": jobs}))
+    return Workflow(str(path), log=task_log("test.workflow"), **kwargs)
+
+def run(workflow:Workflow) -> Workflow:
+    try:
+        asyncio.run(asyncio.wait_for(workflow.run_workflow(), timeout=20))
+    finally:
+        workflow.close()
+    return workflow
+
+def append(path, line:str) -> str:
+    # Shell command recording that it ran, in order
+    return f"sh -c 'echo {line} >> {path}'"
+
+def wait_for_exit(pid:int, timeout:float=5) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            # Killed orphans stay zombies until init reaps them
+            with open(f"/proc/{pid}/stat") as infile:
+                if infile.read().rsplit(")", 1)[1].split()[0] == "Z":
+                    return True
+        except FileNotFoundError:
+            return True
+        time.sleep(0.01)
+    return False
+
+def test_critical_path_order(tmp_path):
+    order = tmp_path / "order"
+    jobs = {
+        "short": {"steps": {"one": {"run": append(order, "short.one")}}},
+        "long": {"steps": {
+            "first": {"run": append(order, "long.first")},
+            "second": {"run": append(order, "long.second"), "dependency": "first"},
+            "third": {"run": append(order, "long.third"), "dependency": "second"},
+        }},
+    }
+    # A single slot runs the tasks in dispatch order
+    result = run(workflow(tmp_path, jobs, concurrency=1))
+    lines = order.read_text().split()
+    assert result.results[TaskResult.PASS] == 4
+    assert lines[0] == "long.first"
+    assert lines.index("long.second") < lines.index("short.one")
+
+def test_cycle_rejected(tmp_path):
+    jobs = {
+        "a": {"dependency": "b", "steps": {"one": {"run": "true"}}},
+        "b": {"dependency": "a", "steps": {"one": {"run": "true"}}},
+    }
+    with pytest.raises(Exception, match="cycle"):
+        workflow(tmp_path, jobs)
+
+def test_retries(tmp_path):
+    jobs = {"j": {"steps": {"flaky": {"run": f"sh -c 'echo x >> {tmp_path}/attempts; exit 1'", "retries": 2, "backoff": 0.01}}}}
+    result = run(workflow(tmp_path, jobs))
+    task = result.failed["j.flaky.0"]
+    assert task.result == TaskResult.FAIL
+    assert task.attempts == 3
+    assert len((tmp_path / "attempts").read_text().split()) == 3
+    assert result.results[TaskResult.FAIL] == 1
+
+def test_backoff_frees_the_slot(tmp_path):
+    order = tmp_path / "order"
+    jobs = {"j": {"steps": {
+        "flaky": {"run": f"sh -c 'echo flaky >> {order}; exit 1'", "retries": 1, "backoff": 0.5},
+        "other": {"run": append(order, "other")},
+    }}}
+    # The only slot runs the other step while the failure waits out its backoff
+    result = run(workflow(tmp_path, jobs, concurrency=1))
+    assert order.read_text().split() == ["flaky", "other", "flaky"]
+    assert result.failed["j.flaky.0"].attempts == 2
+
+def test_fail_fast(tmp_path):
+    pid = tmp_path / "pid"
+    jobs = {"j": {"steps": {
+        "slow": {"run": f"sh -c 'echo $$ > {pid}; exec sleep 30'"},
+        "bad": {"run": "sh -c 'sleep 0.3; exit 1'"},
+        "after": {"run": "true", "dependency": "bad"},
+    }}}
+    start = time.monotonic()
+    result = run(workflow(tmp_path, jobs, concurrency=2, policy=FailurePolicy.FAIL_FAST))
+    assert time.monotonic() - start < 10
+    assert result.failed["j.bad.0"].result == TaskResult.FAIL
+    assert result.failed["j.slow.0"].result == TaskResult.CANCELLED
+    assert result.tree["j.after"].result == TaskResult.CANCELLED
+    assert not result.tasks
+    # The subprocess of the cancelled task was killed, not left running
+    assert wait_for_exit(int(pid.read_text()))
+
+def test_keep_going_skips_dependents(tmp_path):
+    jobs = {
+        "a": {"steps": {
+            "bad": {"run": "false"},
+            "after": {"run": "true", "dependency": "bad"},
+            "other": {"run": "true"},
+        }},
+        "b": {"dependency": "a", "steps": {"x": {"run": "true"}}},
+    }
+    result = run(workflow(tmp_path, jobs))
+    assert result.skipped == ["a.after", "b.x"]
+    assert (result.results[TaskResult.PASS], result.results[TaskResult.FAIL]) == (1, 1)
+    assert result.tree["a.other"].result == None
+    assert result.tree["b.x"].result == TaskResult.CANCELLED
+
+def test_render_failure_fails_only_its_step(tmp_path):
+    jobs = {"a": {"steps": {
+        "bad": {"run": "echo {x}", "variables": {"x": [1]}},
+        "late": {"run": "echo {i}", "variables": {"i": [1, 2, 3]}},
+        "good": {"run": "true"},
+        "after": {"run": "true", "dependency": "bad"},
+    }}}
+    flow = workflow(tmp_path, jobs, concurrency=1)
+    # Validation rejects mapping variables, inject one to fail the expansion at run time
+    flow.tree["a.bad"].data = dict(flow.tree["a.bad"].data, variables={"x": {"a": 1}})
+    expand = flow.dynamic_tasks
+    def dynamic_tasks(data):
+        specs = expand(data)
+        if "{i}" not in data["run"]:
+            return specs
+        def broken():
+            yield next(specs)
+            raise Exception("render failed")
+        return broken()
+    flow.dynamic_tasks = dynamic_tasks
+
+    result = run(flow)
+    assert set(result.errors) == {"a.bad", "a.late"}
+    assert "render failed" in result.errors["a.late"]
+    assert result.skipped == ["a.after"]
+    # The first task of the failing step and the other steps still ran
+    assert result.results[TaskResult.PASS] == 2
+    assert result.tree["a.good"].result == None
+    assert result.tree["a.late"].result == TaskResult.FAIL